@@ -0,0 +1,430 @@
+import asyncio
+import argparse
+import json
+import multiprocessing
+import os
+import queue
+import random
+import sys
+import time
+import websockets
+
+# 默认压测的服务器地址
+BENCH_SERVER = "127.0.0.1:8765"
+
+# 默认使用的频道，模拟客户端按布局分配到这些频道
+BENCH_CHANNELS = "public,1,2,3"
+
+# 每个压测进程最多保留的延迟样本数，超出后按蓄水池抽样替换
+LATENCY_SAMPLE_LIMIT = 1000000
+
+# 发送阶段结束后继续统计的时间（秒），等待已发出的消息投递完成
+DRAIN_TIME = 2
+
+# 等待服务器回复登录和切换频道的超时时间（秒）
+REPLY_TIMEOUT = 30
+
+# 每个压测进程同时进行的连接握手数
+CONNECT_CONCURRENCY = 200
+
+# 服务器进程内存和 CPU 时间的采样间隔（秒）
+RSS_SAMPLE_INTERVAL = 0.5
+
+# 压测消息的前缀，消息正文为 "前缀 发送时间"，接收方据此计算端到端延迟
+BENCH_PREFIX = "bench "
+
+# 服务器以 "error" 策略限流时回复的错误消息
+RATE_LIMITED_MESSAGE = "发送消息过于频繁"
+
+def log(message):
+    """输出进度信息到标准错误，标准输出只保留 JSON 结果"""
+    print(message, file=sys.stderr, flush=True)
+
+def assign_channels(count, channel_list, layout):
+    """按频道布局为模拟客户端分配频道：uniform 平均分配，skewed 按 1/k 的比例集中到靠前的频道"""
+    if layout == "uniform":
+        return [channel_list[i % len(channel_list)] for i in range(count)]
+    weights = [1 / (rank + 1) for rank in range(len(channel_list))]
+    return random.Random(0).choices(channel_list, weights, k=count)
+
+def percentile(sorted_values, fraction):
+    """返回已排序列表的百分位数"""
+    if not sorted_values:
+        return None
+    return sorted_values[min(int(len(sorted_values) * fraction), len(sorted_values) - 1)]
+
+def read_process_usage(pid):
+    """读取进程及其所有子进程的常驻内存（KB）和已用 CPU 时间（秒），进程不存在时返回 (0, 0)"""
+    rss_kb = 0
+    cpu_seconds = 0
+    try:
+        with open(f"/proc/{pid}/status") as status:
+            for line in status:
+                if line.startswith("VmRSS:"):
+                    rss_kb += int(line.split()[1])
+                    break
+        with open(f"/proc/{pid}/stat") as stat:
+            # 进程名可能包含空格，从最后一个右括号之后开始按字段拆分，utime 和 stime 位于第 14、15 个字段
+            fields = stat.read().rsplit(")", 1)[1].split()
+            cpu_seconds += (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+        for task in os.listdir(f"/proc/{pid}/task"):
+            with open(f"/proc/{pid}/task/{task}/children") as children:
+                for child in children.read().split():
+                    child_rss_kb, child_cpu_seconds = read_process_usage(int(child))
+                    rss_kb += child_rss_kb
+                    cpu_seconds += child_cpu_seconds
+    except (FileNotFoundError, ProcessLookupError):
+        pass
+    return rss_kb, cpu_seconds
+
+def server_cpu_usage(samples, start, end):
+    """根据采样计算服务器在 [start, end] 时间段内使用的 CPU 时间（秒）"""
+    window = [cpu_seconds for sample_time, _, cpu_seconds in samples if start <= sample_time <= end]
+    if len(window) < 2:
+        return None
+    return window[-1] - window[0]
+
+class BenchStats:
+    """单个压测进程的统计数据"""
+
+    def __init__(self):
+        self.connected = 0
+        self.failed = 0
+        self.rejected = 0  # 被服务器准入控制拒绝（503）后重试的次数
+        self.sent = 0  # 发出的聊天消息数
+        self.rate_limited = 0  # 被服务器限流拒绝的聊天消息数（服务器回复了限流错误）
+        self.list_sent = 0  # 发出的 list_command 请求数
+        self.received = 0  # 统计期间收到的聊天消息数（扇出后）
+        self.latencies = []  # 端到端延迟样本（秒）
+        self.latency_count = 0  # 见过的延迟样本总数
+        self.measuring = False
+
+    def record_latency(self, latency):
+        """记录一个延迟样本，超出上限后用蓄水池抽样保持样本均匀"""
+        self.latency_count += 1
+        if len(self.latencies) < LATENCY_SAMPLE_LIMIT:
+            self.latencies.append(latency)
+        else:
+            index = random.randrange(self.latency_count)
+            if index < LATENCY_SAMPLE_LIMIT:
+                self.latencies[index] = latency
+
+class BenchClient:
+    """一个模拟客户端，使用与 ChatClient 相同的 JSON 协议"""
+
+    def __init__(self, stats, username, channel):
+        self.stats = stats
+        self.username = username
+        self.channel = channel
+        self.websocket = None
+        self.reader_task = None
+
+    async def wait_reply(self, expected):
+        """等待以 expected 开头的系统消息，收到错误消息时抛出异常"""
+        while True:
+            data = json.loads(await self.websocket.recv())
+            if data.get('type') == 'error':
+                raise RuntimeError(data.get('message'))
+            if data.get('type') == 'system' and data.get('message', '').startswith(expected):
+                return
+
+    async def connect(self, url):
+        """连接服务器，像 ChatClient 一样先登录公共频道，再切换到分配的频道"""
+        self.websocket = await websockets.connect(url, max_queue=None)
+        await self.websocket.send(json.dumps({
+            'action': 'login',
+            'username': self.username,
+            'channel': 'public'
+        }))
+        await self.wait_reply('成功登录')
+
+        if self.channel != 'public':
+            await self.websocket.send(json.dumps({
+                'action': 'choose',
+                'username': self.username,
+                'old_channel': 'public',
+                'new_channel': self.channel
+            }))
+            await self.wait_reply('已切换到频道')
+
+        self.reader_task = asyncio.create_task(self.read_loop())
+
+    async def read_loop(self):
+        """持续接收消息，统计扇出数量和端到端延迟"""
+        stats = self.stats
+        try:
+            async for message in self.websocket:
+                # 先做字符串检查，避免解析与压测无关的消息
+                if not stats.measuring:
+                    continue
+                if BENCH_PREFIX in message:
+                    data = json.loads(message)
+                    text = data.get('message', '')
+                    if data.get('type') == 'message' and text.startswith(BENCH_PREFIX):
+                        stats.received += 1
+                        stats.record_latency(time.monotonic() - float(text[len(BENCH_PREFIX):]))
+                elif RATE_LIMITED_MESSAGE in message:
+                    if json.loads(message).get('type') == 'error':
+                        stats.rate_limited += 1
+        except websockets.exceptions.ConnectionClosed:
+            pass
+
+    async def send_loop(self, rate, duration, list_every):
+        """以 rate 条/秒的速率发送消息，每发 list_every 次请求一次频道用户列表；rate 为 0 时只保持连接"""
+        if rate <= 0:
+            await asyncio.sleep(duration)
+            return
+        interval = 1 / rate
+        loop = asyncio.get_running_loop()
+        end = loop.time() + duration
+        # 随机错开各客户端的首次发送时间
+        next_send = loop.time() + random.uniform(0, interval)
+        count = 0
+        while next_send < end:
+            await asyncio.sleep(max(0, next_send - loop.time()))
+            next_send += interval
+            count += 1
+            if list_every and count % list_every == 0:
+                await self.websocket.send(json.dumps({'action': 'list_command', 'channel_id': self.channel}))
+                self.stats.list_sent += 1
+                continue
+            # time.monotonic 在 Linux 上是系统范围的时钟，可跨压测进程比较
+            await self.websocket.send(json.dumps({
+                'action': 'message',
+                'message': f"{BENCH_PREFIX}{time.monotonic()}"
+            }))
+            self.stats.sent += 1
+
+    async def leave(self):
+        """离开频道并关闭连接"""
+        try:
+            await self.websocket.send(json.dumps({'action': 'leave'}))
+            await self.websocket.close()
+        except websockets.exceptions.ConnectionClosed:
+            pass
+        if self.reader_task is not None:
+            self.reader_task.cancel()
+
+async def run_bench_process(process_id, args, channel_list, barrier):
+    """单个压测进程：建立连接，与其他进程同步后开始发送，返回统计结果"""
+    stats = BenchStats()
+    url = f"ws://{args.server}"
+    clients = [BenchClient(stats, f"bench{process_id}_{index}", channel)
+               for index, channel in enumerate(channel_list)]
+
+    # 建立连接阶段
+    semaphore = asyncio.Semaphore(CONNECT_CONCURRENCY)
+    async def connect(client):
+        async with semaphore:
+            deadline = time.monotonic() + REPLY_TIMEOUT
+            while True:
+                try:
+                    await asyncio.wait_for(client.connect(url), deadline - time.monotonic())
+                    stats.connected += 1
+                    return
+                except websockets.exceptions.InvalidStatus as e:
+                    # 服务器繁忙时按 Retry-After 等待后重试，与真实客户端的重连行为一致
+                    retry_after = e.response.headers.get("Retry-After")
+                    if e.response.status_code == 503 and retry_after and \
+                            time.monotonic() + int(retry_after) < deadline:
+                        stats.rejected += 1
+                        await asyncio.sleep(int(retry_after))
+                        continue
+                    error = e
+                except Exception as e:
+                    error = e
+                stats.failed += 1
+                if stats.failed == 1:
+                    log(f"压测进程 {process_id} 连接失败: {error!r}")
+                return
+
+    connect_start = time.monotonic()
+    await asyncio.gather(*(connect(client) for client in clients))
+    connect_elapsed = time.monotonic() - connect_start
+    connected = [client for client in clients if client.reader_task is not None]
+
+    # 等待所有压测进程都完成连接后再同时开始发送
+    await asyncio.to_thread(barrier.wait)
+
+    stats.measuring = True
+    send_start = time.monotonic()
+    await asyncio.gather(*(client.send_loop(args.rate, args.duration, args.list_every) for client in connected))
+    send_elapsed = time.monotonic() - send_start
+    await asyncio.sleep(DRAIN_TIME)
+    stats.measuring = False
+    measure_end = time.monotonic()
+
+    await asyncio.gather(*(client.leave() for client in connected))
+
+    return {
+        "connected": stats.connected,
+        "failed": stats.failed,
+        "rejected": stats.rejected,
+        "connect_elapsed": connect_elapsed,
+        "sent": stats.sent,
+        "rate_limited": stats.rate_limited,
+        "list_sent": stats.list_sent,
+        "send_elapsed": send_elapsed,
+        "received": stats.received,
+        "send_start": send_start,
+        "measure_end": measure_end,
+        "latencies": stats.latencies
+    }
+
+def bench_process(process_id, args, channel_list, barrier, results):
+    """压测进程入口"""
+    try:
+        import resource
+        # 每个模拟客户端占用一个文件描述符
+        _, hard_limit = resource.getrlimit(resource.RLIMIT_NOFILE)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard_limit, hard_limit))
+    except (ImportError, ValueError, OSError):
+        pass
+
+    try:
+        results.put(asyncio.run(run_bench_process(process_id, args, channel_list, barrier)))
+    except Exception as e:
+        log(f"压测进程 {process_id} 出错: {e!r}")
+        # 让其他仍在等待同步的压测进程也退出
+        barrier.abort()
+        results.put(None)
+
+def summarize(args, results, usage_samples):
+    """汇总各压测进程的结果"""
+    connected = sum(result["connected"] for result in results)
+    sent = sum(result["sent"] for result in results)
+    rate_limited = sum(result["rate_limited"] for result in results)
+    # 被限流的消息没有进入频道，吞吐和扇出按服务器接受的消息计算
+    accepted = sent - rate_limited
+    received = sum(result["received"] for result in results)
+    connect_elapsed = max(result["connect_elapsed"] for result in results)
+    send_elapsed = max(result["send_elapsed"] for result in results)
+    measure_start = min(result["send_start"] for result in results)
+    measure_end = max(result["measure_end"] for result in results)
+    measure_elapsed = measure_end - measure_start
+    rss_samples = [rss_kb for _, rss_kb, _ in usage_samples]
+    # 全部连接建立并登录后、开始发送前的内存增量，按连接数分摊为每个会话占用的内存
+    idle_samples = [rss_kb for sample_time, rss_kb, _ in usage_samples if sample_time <= measure_start]
+    session_kb = idle_samples[-1] - idle_samples[0] if len(idle_samples) > 1 and connected else None
+    cpu_seconds = server_cpu_usage(usage_samples, measure_start, measure_end)
+    latencies = sorted(latency for result in results for latency in result["latencies"])
+
+    def to_ms(value):
+        return None if value is None else round(value * 1000, 3)
+
+    return {
+        "config": {
+            "server": args.server,
+            "clients": args.clients,
+            "processes": args.processes,
+            "channels": args.channels.split(","),
+            "layout": args.layout,
+            "rate": args.rate,
+            "duration": args.duration,
+            "list_every": args.list_every
+        },
+        "connect": {
+            "connected": connected,
+            "failed": sum(result["failed"] for result in results),
+            "rejected": sum(result["rejected"] for result in results),
+            "elapsed": round(connect_elapsed, 3),
+            "rate": round(connected / connect_elapsed, 1) if connect_elapsed else None
+        },
+        "messages": {
+            "sent": sent,
+            "rate_limited": rate_limited,
+            "accepted": accepted,
+            "list_sent": sum(result["list_sent"] for result in results),
+            "rate": round(accepted / send_elapsed, 1) if send_elapsed else None
+        },
+        "fanout": {
+            "received": received,
+            "rate": round(received / measure_elapsed, 1) if measure_elapsed else None,
+            "per_message": round(received / accepted, 2) if accepted else None
+        },
+        "latency_ms": {
+            "samples": len(latencies),
+            "p50": to_ms(percentile(latencies, 0.5)),
+            "p99": to_ms(percentile(latencies, 0.99)),
+            "p999": to_ms(percentile(latencies, 0.999)),
+            "max": to_ms(latencies[-1] if latencies else None)
+        },
+        "server_rss_kb": {
+            "start": rss_samples[0] if rss_samples else None,
+            "peak": max(rss_samples) if rss_samples else None,
+            "end": rss_samples[-1] if rss_samples else None,
+            "per_session_bytes": None if session_kb is None else round(session_kb * 1024 / connected),
+            "per_100k_sessions_mb": None if session_kb is None else round(session_kb / connected * 100000 / 1024, 1)
+        },
+        # 统计期间服务器的 CPU 时间，按收到的消息和投递的消息分摊，用于比较每条消息的处理开销
+        "server_cpu": {
+            "seconds": None if cpu_seconds is None else round(cpu_seconds, 3),
+            "per_message_us": round(cpu_seconds / accepted * 1e6, 1) if cpu_seconds is not None and accepted else None,
+            "per_delivery_us": round(cpu_seconds / received * 1e6, 2) if cpu_seconds is not None and received else None
+        }
+    }
+
+def run_bench(args):
+    """启动各压测进程，采样服务器内存并汇总结果"""
+    channel_list = assign_channels(args.clients, args.channels.split(","), args.layout)
+    context = multiprocessing.get_context("spawn")
+    barrier = context.Barrier(args.processes)
+    results_queue = context.Queue()
+
+    processes = []
+    for process_id in range(args.processes):
+        process = context.Process(target=bench_process, daemon=True,
+                                  args=(process_id, args, channel_list[process_id::args.processes],
+                                        barrier, results_queue))
+        process.start()
+        processes.append(process)
+    log(f"已启动 {args.processes} 个压测进程，共 {args.clients} 个模拟客户端，目标 {args.server}")
+
+    # 等待结果的同时采样服务器内存和 CPU 时间；结果需先从队列取出，进程才能正常退出
+    usage_samples = []  # (采样时间, 常驻内存, CPU 时间)
+    results = []
+    while len(results) < len(processes):
+        if args.server_pid:
+            usage_samples.append((time.monotonic(), *read_process_usage(args.server_pid)))
+        try:
+            results.append(results_queue.get(timeout=RSS_SAMPLE_INTERVAL))
+        except queue.Empty:
+            if not any(process.is_alive() for process in processes):
+                break
+
+    for process in processes:
+        process.join()
+
+    results = [result for result in results if result is not None]
+    if len(results) < len(processes):
+        raise SystemExit("部分压测进程异常退出，结果不完整")
+
+    rate_limited = sum(result["rate_limited"] for result in results)
+    if rate_limited:
+        log(f"{rate_limited} 条消息被服务器限流，消息速率和扇出只按被接受的消息计算；"
+            f"压测服务器的处理能力时，可将 server.py 中的 RATE_LIMIT_CONNECTION、RATE_LIMIT_USER、"
+            f"RATE_LIMIT_CHANNEL 设为 None 后再运行")
+    return summarize(args, results, usage_samples)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="聊天服务器压测工具，结果以 JSON 输出")
+    parser.add_argument("--server", default=BENCH_SERVER, help="服务器地址 (host:port)")
+    parser.add_argument("--clients", type=int, default=1000, help="模拟客户端总数")
+    parser.add_argument("--processes", type=int, default=1, help="压测进程数")
+    parser.add_argument("--channels", default=BENCH_CHANNELS, help="使用的频道，逗号分隔")
+    parser.add_argument("--layout", choices=("uniform", "skewed"), default="uniform",
+                        help="频道布局：uniform 平均分配，skewed 集中到靠前的频道")
+    parser.add_argument("--rate", type=float, default=0.2, help="每个客户端每秒发送的消息数，0 表示只保持空闲连接")
+    parser.add_argument("--duration", type=float, default=30, help="发送阶段时长（秒）")
+    parser.add_argument("--list-every", type=int, default=0,
+                        help="每个客户端每发送多少次请求一次 list_command，0 表示不请求")
+    parser.add_argument("--server-pid", type=int, help="服务器进程 ID，用于采样内存和 CPU 时间（包括子进程）")
+    parser.add_argument("--output", help="结果写入的文件，默认输出到标准输出")
+    args = parser.parse_args()
+
+    result = json.dumps(run_bench(args), ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as output:
+            output.write(result + "\n")
+    else:
+        print(result)
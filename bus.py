@@ -0,0 +1,301 @@
+import asyncio
+import argparse
+import json
+import itertools
+from abc import ABC, abstractmethod
+from collections import defaultdict
+from itertools import islice
+
+# 单条总线消息的长度上限
+BUS_LINE_LIMIT = 16 * 1024 * 1024
+
+# 等待总线请求回复的超时时间（秒）
+BUS_REQUEST_TIMEOUT = 5
+
+# 独立运行中转端时的默认监听地址
+BROKER_HOST = "127.0.0.1"
+BROKER_PORT = 8766
+
+# 由中转端直接处理、不转发给其他节点的操作
+BROKER_OPS = ("claim", "takeover", "release", "members", "locate", "page")
+
+def encode_message(message):
+    """将总线消息编码为一行 JSON"""
+    return json.dumps(message).encode('utf-8') + b"\n"
+
+class UserDirectory:
+    """全服在线用户索引，同时按用户名和按频道维护，查找和计数都是 O(1)"""
+
+    def __init__(self):
+        self.by_user = {}  # {用户名: {频道: 所在节点}}
+        self.by_channel = defaultdict(dict)  # {频道: {用户名: 所在节点}}
+        self.total = 0
+
+    def claim(self, channel_id, username, owner):
+        """为 owner 占用用户名，已被其他节点占用时返回 False"""
+        current = self.by_channel[channel_id].get(username, owner)
+        if current is not owner:
+            return False
+        self.assign(channel_id, username, owner)
+        return True
+
+    def assign(self, channel_id, username, owner):
+        """无条件将用户名登记到 owner 名下"""
+        if username not in self.by_channel[channel_id]:
+            self.total += 1
+        self.by_channel[channel_id][username] = owner
+        self.by_user.setdefault(username, {})[channel_id] = owner
+
+    def release(self, channel_id, username, owner):
+        """释放 owner 占用的用户名"""
+        if username not in self.by_channel[channel_id] or self.by_channel[channel_id][username] is not owner:
+            return
+        del self.by_channel[channel_id][username]
+        user_channels = self.by_user[username]
+        del user_channels[channel_id]
+        if not user_channels:
+            del self.by_user[username]
+        self.total -= 1
+
+    def release_owner(self, owner):
+        """释放某个节点占用的所有用户名"""
+        for channel_id, members in self.by_channel.items():
+            for username in [username for username, current in members.items() if current is owner]:
+                self.release(channel_id, username, owner)
+
+    def locate(self, username):
+        """返回用户名所在的频道列表"""
+        return list(self.by_user.get(username, ()))
+
+    def members(self, channel_id):
+        """返回频道中的用户名列表"""
+        return list(self.by_channel.get(channel_id, ()))
+
+    def page(self, offset, limit):
+        """分页返回在线用户，附带总数和各频道人数"""
+        entries = ((username, channel_id) for channel_id, members in self.by_channel.items()
+                   for username in members)
+        return {
+            "total": self.total,
+            "counts": {channel_id: len(members) for channel_id, members in self.by_channel.items() if members},
+            "users": [list(entry) for entry in islice(entries, offset, offset + limit)]
+        }
+
+class Backplane(ABC):
+    """集群背板接口：在多个服务器节点（进程）之间同步广播、在线用户和管理员命令
+
+    用户名占用以节点为单位：同一节点内的唯一性由节点自己检查，
+    背板只保证同一频道的用户名不会被两个节点同时占用。
+    """
+
+    @abstractmethod
+    def publish(self, message):
+        """将消息发送给其他所有节点，不等待回复"""
+
+    @abstractmethod
+    async def claim(self, channel_id, username):
+        """为本节点占用频道中的用户名，已被其他节点占用时返回 False"""
+
+    @abstractmethod
+    def takeover(self, channel_id, username):
+        """将用户名的占用强制转移到本节点（凭恢复令牌恢复会话时使用）"""
+
+    @abstractmethod
+    def release(self, channel_id, username):
+        """释放本节点占用的用户名"""
+
+    @abstractmethod
+    async def members(self, channel_id):
+        """返回全集群中频道的在线用户名列表"""
+
+    @abstractmethod
+    async def locate(self, username):
+        """返回用户名在全集群中所在的频道列表"""
+
+    @abstractmethod
+    async def page(self, offset, limit):
+        """分页返回全集群在线用户：{"total": 总数, "counts": {频道: 人数}, "users": [[用户名, 频道]]}"""
+
+class LocalBackplane(Backplane):
+    """单节点的进程内背板，没有其他节点可通知"""
+
+    def __init__(self):
+        self.directory = UserDirectory()  # 所有用户名都登记在本节点（None）名下
+
+    def publish(self, message):
+        pass
+
+    async def claim(self, channel_id, username):
+        return self.directory.claim(channel_id, username, None)
+
+    def takeover(self, channel_id, username):
+        self.directory.assign(channel_id, username, None)
+
+    def release(self, channel_id, username):
+        self.directory.release(channel_id, username, None)
+
+    async def members(self, channel_id):
+        return self.directory.members(channel_id)
+
+    async def locate(self, username):
+        return self.directory.locate(username)
+
+    async def page(self, offset, limit):
+        return self.directory.page(offset, limit)
+
+class BrokerBackplane(Backplane):
+    """通过中转端（BusBroker）与其他节点通信的背板"""
+
+    def __init__(self, handler):
+        self.handler = handler  # 收到其他节点转发的消息时调用
+        self.reader = None
+        self.writer = None
+        self.task = None
+        self.pending = {}  # {请求ID: 等待回复的 Future}
+        self.request_ids = itertools.count(1)
+
+    async def connect_unix(self, path):
+        """连接 Unix 域套接字上的中转端"""
+        self.reader, self.writer = await asyncio.open_unix_connection(path, limit=BUS_LINE_LIMIT)
+        self.task = asyncio.create_task(self.read_loop())
+
+    async def connect_tcp(self, host, port):
+        """连接 TCP 上的独立中转端"""
+        self.reader, self.writer = await asyncio.open_connection(host, port, limit=BUS_LINE_LIMIT)
+        self.task = asyncio.create_task(self.read_loop())
+
+    def publish(self, message):
+        self.writer.write(encode_message(message))
+
+    async def request(self, message):
+        """发送请求并等待中转端的回复"""
+        request_id = next(self.request_ids)
+        future = asyncio.get_running_loop().create_future()
+        self.pending[request_id] = future
+        message["id"] = request_id
+        self.publish(message)
+        try:
+            return await asyncio.wait_for(future, BUS_REQUEST_TIMEOUT)
+        finally:
+            self.pending.pop(request_id, None)
+
+    async def claim(self, channel_id, username):
+        return await self.request({"op": "claim", "channel": channel_id, "username": username})
+
+    def takeover(self, channel_id, username):
+        self.publish({"op": "takeover", "channel": channel_id, "username": username})
+
+    def release(self, channel_id, username):
+        self.publish({"op": "release", "channel": channel_id, "username": username})
+
+    async def members(self, channel_id):
+        return await self.request({"op": "members", "channel": channel_id})
+
+    async def locate(self, username):
+        return await self.request({"op": "locate", "username": username})
+
+    async def page(self, offset, limit):
+        return await self.request({"op": "page", "offset": offset, "limit": limit})
+
+    async def read_loop(self):
+        """接收中转端发来的消息"""
+        try:
+            async for line in self.reader:
+                message = json.loads(line)
+                if message.get("op") == "reply":
+                    future = self.pending.get(message["id"])
+                    if future is not None and not future.done():
+                        future.set_result(message["result"])
+                    continue
+
+                try:
+                    self.handler(message)
+                except Exception as e:
+                    print(f"处理总线消息错误: {e}")
+        except ConnectionError as e:
+            print(f"消息总线连接错误: {e}")
+        print("与消息总线的连接已断开")
+
+class BusBroker:
+    """消息总线的中转端：在节点之间转发消息，并维护全集群的用户名占用表"""
+
+    def __init__(self):
+        self.nodes = set()  # 已连接的节点
+        self.directory = UserDirectory()  # 全集群的用户名占用表
+
+    async def serve_unix(self, path):
+        """在 Unix 域套接字上启动中转端（单机多进程模式）"""
+        return await asyncio.start_unix_server(self.handle_node, path, limit=BUS_LINE_LIMIT)
+
+    async def serve_tcp(self, host, port):
+        """在 TCP 端口上启动中转端（多节点模式）"""
+        return await asyncio.start_server(self.handle_node, host, port, limit=BUS_LINE_LIMIT)
+
+    async def handle_node(self, reader, writer):
+        """处理单个节点的连接"""
+        self.nodes.add(writer)
+        try:
+            async for line in reader:
+                message = json.loads(line)
+                if message.get("op") in BROKER_OPS:
+                    self.handle_presence(writer, message)
+                    continue
+
+                # 其余消息原样转发给其他节点，每个节点只转发一份
+                others = [other for other in self.nodes if other is not writer]
+                for other in others:
+                    other.write(line)
+                for other in others:
+                    try:
+                        await other.drain()
+                    except ConnectionError:
+                        pass
+        except (ConnectionError, json.JSONDecodeError) as e:
+            print(f"消息总线连接错误: {e}")
+        finally:
+            # 节点断开时释放其占用的用户名
+            self.nodes.discard(writer)
+            self.directory.release_owner(writer)
+            writer.close()
+
+    def handle_presence(self, writer, message):
+        """维护用户名占用表并回复查询"""
+        op = message["op"]
+        channel_id = message.get("channel")
+        username = message.get("username")
+
+        if op == "takeover":
+            self.directory.assign(channel_id, username, writer)
+            return
+
+        if op == "release":
+            self.directory.release(channel_id, username, writer)
+            return
+
+        if op == "claim":
+            result = self.directory.claim(channel_id, username, writer)
+        elif op == "members":
+            result = self.directory.members(channel_id)
+        elif op == "locate":
+            result = self.directory.locate(username)
+        else:  # page
+            result = self.directory.page(message["offset"], message["limit"])
+
+        writer.write(encode_message({"op": "reply", "id": message["id"], "result": result}))
+
+async def run_broker(host, port):
+    """以独立进程运行中转端"""
+    server = await BusBroker().serve_tcp(host, port)
+    print(f"消息总线中转端已启动，监听 {host}:{port}")
+    async with server:
+        await server.serve_forever()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="聊天服务器集群的消息总线中转端")
+    parser.add_argument("--host", default=BROKER_HOST, help="监听地址")
+    parser.add_argument("--port", type=int, default=BROKER_PORT, help="监听端口")
+    args = parser.parse_args()
+    try:
+        asyncio.run(run_broker(args.host, args.port))
+    except KeyboardInterrupt:
+        print("\n中转端已关闭")
@@ -0,0 +1,441 @@
+import asyncio
+import hashlib
+import itertools
+import json
+import random
+from collections import deque
+import websockets
+from protocol import BINARY_SUBPROTOCOL, BinaryCodec
+
+# 加入频道时请求回放的历史消息条数
+HISTORY_REPLAY = 20
+
+# 服务器支持时使用二进制编码接收消息（帧更小，解码更快），否则使用 JSON 文本
+USE_BINARY_PROTOCOL = True
+
+# 是否协商 permessage-deflate 压缩，服务器只压缩较大的消息（用户列表、历史回放等）
+USE_COMPRESSION = True
+
+# 连接意外断开后是否自动重连并恢复用户名、频道和管理员身份
+AUTO_RECONNECT = True
+
+# 重连退避（秒）：第 n 次重连前在 0 到 min(上限, 初始值 * 2^n) 之间随机等待
+RECONNECT_BASE_DELAY = 1
+RECONNECT_MAX_DELAY = 30
+
+# 断线或登录期间最多保留的待发送消息条数，超出时丢弃最早的消息
+OFFLINE_QUEUE_LIMIT = 100
+
+# 发送队列中的请求达到该条数时，send 等待队列发完再返回
+SEND_QUEUE_LIMIT = 1000
+
+# 尚未被 events() 取走的事件最多保留的条数，超出时丢弃最早的事件
+EVENT_BUFFER_SIZE = 10000
+
+# 表示用户已被移出频道的系统消息
+EVICTION_NOTICES = ('已从频道被踢出', '该频道已被清退', '该频道被封禁')
+
+def hash_password(password):
+    """对密码进行哈希处理"""
+    return hashlib.sha256(password.encode('utf-8')).hexdigest()
+
+class ChatError(Exception):
+    """服务器拒绝了请求"""
+
+class PasswordRequired(ChatError):
+    """管理员登录需要密码"""
+
+class Event:
+    """客户端收到的一条事件
+
+    type 为服务器消息类型（message、system、presence、error 等）时，其余字段与服务器消息相同；
+    客户端自身产生的事件类型为 connected、disconnected、reconnecting、dropped、invalid 和 closed，
+    closed 是事件流的最后一个事件。字段可以通过属性或 get 读取。
+    """
+
+    __slots__ = ("type", "channel", "data")
+
+    def __init__(self, event_type, channel, data):
+        self.type = event_type
+        self.channel = channel
+        self.data = data
+
+    def __getattr__(self, name):
+        try:
+            return self.data[name]
+        except KeyError:
+            raise AttributeError(name) from None
+
+    def get(self, key, default=None):
+        """读取字段，不存在时返回 default"""
+        return self.data.get(key, default)
+
+    def __repr__(self):
+        return f"Event({self.type!r}, {self.channel!r}, {self.data!r})"
+
+class AsyncChatClient:
+    """无终端输入输出的异步聊天客户端，可在同一个事件循环中运行多个
+
+    连接意外断开后自动重连，并凭恢复令牌（令牌失效时重新登录）恢复用户名、频道和管理员身份；
+    断线和登录期间发送的消息暂存，会话恢复后按顺序发出。服务器消息和连接状态变化通过 events() 读取。
+    """
+
+    def __init__(self, server_address, use_binary=USE_BINARY_PROTOCOL, use_compression=USE_COMPRESSION,
+                 auto_reconnect=AUTO_RECONNECT):
+        self.server_address = server_address
+        self.use_binary = use_binary
+        self.use_compression = use_compression
+        self.auto_reconnect = auto_reconnect
+        self.username = None
+        self.channel = None  # 当前所在频道，未加入频道时为 None
+        self.joined = False  # 是否已加入频道
+        self.is_admin = False  # 是否为管理员
+        self.resume_token = None  # 服务器下发的会话恢复令牌
+        self.last_seq = 0  # 当前频道已收到的最新消息序号
+        self.password_hash = None  # 管理员密码哈希，重连后重新登录时使用
+        self.codec = BinaryCodec()  # 二进制消息解码器，频道表由服务器在连接时下发
+        self.websocket = None  # 当前连接，断线期间为 None
+        self.outgoing = asyncio.Queue()  # 当前连接待发送的请求，None 表示发送完后关闭连接
+        self.login_pending = False  # 是否已发出登录或恢复请求而尚未收到结果
+        self.login_request = None  # 最近一次登录请求的ID，只有该请求被拒绝时才丢弃暂存的消息
+        self.held_messages = deque(maxlen=OFFLINE_QUEUE_LIMIT)  # 登录完成前或断线期间发送的消息
+        self.reply_waiters = {}  # 等待登录或切换频道结果的 Future：{请求ID: Future}
+        self.request_ids = itertools.count(1)  # 登录和切换频道请求的ID，服务器在结果中原样带回
+        self.closed_by_server = False  # 服务器是否主动正常关闭了连接（被管理员断开、超时等）
+        self.closing = False  # 是否已调用 close
+        self.stopping = asyncio.Event()  # 调用 close 时设置，结束重连等待
+        self.event_buffer = deque(maxlen=EVENT_BUFFER_SIZE)
+        self.event_ready = asyncio.Event()
+        self.ready = None  # 首次连接的结果
+        self.task = None
+
+    async def start(self):
+        """连接服务器并在后台接收消息，首次连接失败时抛出连接异常"""
+        self.ready = asyncio.get_running_loop().create_future()
+        self.task = asyncio.create_task(self.run())
+        await self.ready
+
+    async def close(self):
+        """离开频道并关闭连接，不再重连"""
+        self.closing = True
+        self.stopping.set()
+        if self.websocket is not None:
+            self.outgoing.put_nowait({'action': 'leave'})
+            self.outgoing.put_nowait(None)
+        if self.task is not None:
+            await self.task
+
+    async def events(self):
+        """依次产生收到的事件，产生 closed 事件后结束"""
+        while True:
+            while self.event_buffer:
+                event = self.event_buffer.popleft()
+                yield event
+                if event.type == 'closed':
+                    return
+            self.event_ready.clear()
+            await self.event_ready.wait()
+
+    def emit(self, event_type, channel, data):
+        """记录一个事件并唤醒 events() 的读取者"""
+        event = Event(event_type, channel, data)
+        self.event_buffer.append(event)
+        self.event_ready.set()
+        return event
+
+    async def run(self):
+        """保持连接：连接意外断开后按指数退避重连，直到调用 close 或服务器主动关闭连接"""
+        attempt = 0  # 连续重连失败的次数
+        try:
+            while not self.closing:
+                error = None
+                retry_after = None
+                try:
+                    subprotocols = [BINARY_SUBPROTOCOL] if self.use_binary else None
+                    compression = "deflate" if self.use_compression else None
+                    async with websockets.connect(f"ws://{self.server_address}", subprotocols=subprotocols,
+                                                  compression=compression) as websocket:
+                        self.websocket = websocket
+                        self.outgoing = asyncio.Queue()
+                        send_task = asyncio.create_task(self.send_loop(websocket, self.outgoing))
+                        attempt = 0
+
+                        # 重连时先恢复会话，再发出断线期间暂存的消息
+                        if self.ready.done():
+                            self.restore_session()
+                        else:
+                            self.ready.set_result(None)
+                        self.emit('connected', self.channel, {})
+
+                        try:
+                            await self.receive_loop(websocket)
+                        finally:
+                            send_task.cancel()
+
+                except websockets.exceptions.InvalidStatus as e:
+                    # 服务器繁忙时以 503 拒绝连接，并在 Retry-After 中给出建议的等待时间
+                    error = e
+                    retry_after = e.response.headers.get("Retry-After")
+                except Exception as e:
+                    error = e
+                finally:
+                    self.detach()
+
+                if not self.ready.done():
+                    self.ready.set_exception(error)
+                    return
+
+                # 调用了 close 或服务器主动断开时不重连
+                if self.closing or not self.auto_reconnect or self.closed_by_server:
+                    break
+
+                # 在 0 到退避上限之间随机等待，避免大量客户端同时重连；服务器给出的等待时间作为下限
+                delay = random.uniform(0, min(RECONNECT_MAX_DELAY, RECONNECT_BASE_DELAY * 2 ** attempt))
+                if retry_after and retry_after.isdigit():
+                    delay += int(retry_after)
+                attempt += 1
+                self.emit('reconnecting', self.channel, {
+                    'delay': delay,
+                    'attempt': attempt,
+                    'error': None if error is None else str(error)
+                })
+                try:
+                    await asyncio.wait_for(self.stopping.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            self.closing = True
+            self.resolve_replies(self.emit('closed', self.channel, {}))
+
+    def detach(self):
+        """连接断开后的清理：未发出的聊天消息放回暂存队列，等待中的请求以断开结束"""
+        self.websocket = None
+        self.resolve_replies(Event('disconnected', self.channel, {}))
+        unsent = []
+        while not self.outgoing.empty():
+            request = self.outgoing.get_nowait()
+            self.outgoing.task_done()
+            if request is not None and request['action'] == 'message':
+                unsent.append(request['message'])
+        self.held_messages.extendleft(reversed(unsent))
+
+    def restore_session(self):
+        """重连后恢复会话：优先凭恢复令牌恢复并补发错过的消息，令牌失效时重新登录"""
+        if self.resume_token:
+            self.send_request({
+                'action': 'resume',
+                'resume_token': self.resume_token,
+                'history': {'since': self.last_seq}
+            })
+            self.login_pending = True
+        elif self.joined and self.username:
+            self.request_login(self.username, self.channel, self.password_hash)
+        else:
+            self.finish_login(True)
+
+    async def send_loop(self, websocket, outgoing):
+        """依次发送队列中的请求，收到 None 时关闭连接"""
+        try:
+            while True:
+                request = await outgoing.get()
+                try:
+                    if request is None:
+                        await websocket.close()
+                        return
+                    await websocket.send(json.dumps(request))
+                finally:
+                    outgoing.task_done()
+        except websockets.exceptions.ConnectionClosed:
+            pass
+
+    async def receive_loop(self, websocket):
+        """接收服务器消息直到连接关闭"""
+        while True:
+            try:
+                message = await websocket.recv()
+            except websockets.exceptions.ConnectionClosed as e:
+                # 服务器以 1000 正常关闭表示主动断开（被管理员断开、超时等），不再重连
+                self.closed_by_server = e.rcvd is not None and e.rcvd.code == 1000 and e.rcvd_then_sent
+                self.emit('disconnected', self.channel, {
+                    'code': None if e.rcvd is None else e.rcvd.code,
+                    'reason': None if e.rcvd is None else e.rcvd.reason
+                })
+                return
+
+            try:
+                if isinstance(message, bytes):
+                    data = self.codec.decode(message)
+                    if data['type'] == 'channels':
+                        self.codec.set_channels(data['channels'])
+                        continue
+                else:
+                    data = json.loads(message)
+                event_type = data.pop('type')
+            except (ValueError, KeyError, IndexError, TypeError):
+                self.emit('invalid', self.channel, {})
+                continue
+            self.handle_message(self.emit(event_type, data.pop('channel', ''), data))
+
+    def handle_message(self, event):
+        """根据服务器消息更新会话状态，并唤醒等待登录或切换频道结果的调用者"""
+        # 记录会话恢复令牌和已收到的消息序号，供断线重连使用
+        if 'resume_token' in event.data:
+            self.resume_token = event.data['resume_token']
+        if 'seq' in event.data:
+            self.last_seq = event.data['seq']
+        elif event.type == 'history':
+            self.last_seq = event.data.get('last_seq', self.last_seq)
+
+        if event.type == 'system':
+            message = event.data.get('message', '')
+            if message.startswith('成功登录'):
+                self.channel = event.channel
+                self.joined = True
+                self.is_admin = 'admin_commands' in event.data
+                self.finish_login(True)
+            elif message.startswith('已切换到频道') or message.startswith('成功加入频道'):
+                self.channel = event.channel
+                self.joined = True
+            elif any(notice in message for notice in EVICTION_NOTICES):
+                self.channel = None
+                self.joined = False
+        elif event.type == 'resumed':
+            # 恢复成功时沿用原用户名、频道和管理员身份
+            self.username = event.data.get('username', self.username)
+            self.channel = event.channel
+            self.is_admin = event.data.get('is_admin', self.is_admin)
+            self.joined = True
+            self.finish_login(True)
+        elif event.type == 'resume_failed':
+            self.resume_token = None
+            if self.joined and self.username:
+                self.request_login(self.username, self.channel, self.password_hash)
+            else:
+                self.finish_login(True)
+        elif event.type == 'error':
+            # 限流、查询被拒绝等与登录无关的错误不影响暂存的消息
+            if self.login_pending and event.data.get('request_id') == self.login_request:
+                self.finish_login(False)
+
+        # 登录和切换频道的结果带有请求ID，只唤醒对应的请求
+        if event.data.get('request_id') is not None:
+            self.resolve_reply(event.data['request_id'], event)
+
+    def resolve_reply(self, request_id, event):
+        """以 event 作为结果唤醒请求 request_id 的等待者"""
+        waiter = self.reply_waiters.pop(request_id, None)
+        if waiter is not None and not waiter.done():
+            waiter.set_result(event)
+
+    def resolve_replies(self, event):
+        """以 event 作为结果唤醒所有等待中的请求"""
+        waiters, self.reply_waiters = self.reply_waiters, {}
+        for waiter in waiters.values():
+            if not waiter.done():
+                waiter.set_result(event)
+
+    def wait_reply(self, request_id):
+        """返回请求 request_id 的结果的 Future"""
+        waiter = asyncio.get_running_loop().create_future()
+        self.reply_waiters[request_id] = waiter
+        return waiter
+
+    def check_reply(self, event):
+        """请求成功时返回结果事件，否则抛出 ChatError"""
+        if event.type == 'require_password':
+            raise PasswordRequired(event.get('message', ''))
+        if event.type == 'error':
+            raise ChatError(event.get('message', ''))
+        if event.type == 'closed':
+            raise ChatError("连接已关闭")
+        if event.type == 'disconnected':
+            raise ChatError("连接已断开，请求结果未知")
+        return event
+
+    def send_request(self, request):
+        """将请求放入发送队列，断线期间抛出 ConnectionError"""
+        if self.closing:
+            raise ConnectionError("客户端已关闭")
+        if self.websocket is None:
+            raise ConnectionError("正在重新连接服务器")
+        self.outgoing.put_nowait(request)
+
+    def request_login(self, username, channel, password_hash=None, history=HISTORY_REPLAY):
+        """发出登录请求，返回登录结果的 Future；结果返回前发送的消息暂存"""
+        request_id = next(self.request_ids)
+        request = {
+            'action': 'login',
+            'username': username,
+            'channel': channel,
+            'history': {'last': history},
+            'request_id': request_id
+        }
+        if password_hash:
+            request['password_hash'] = password_hash
+        self.send_request(request)
+        self.username = username
+        if password_hash:
+            self.password_hash = password_hash
+        self.login_pending = True
+        self.login_request = request_id
+        return self.wait_reply(request_id)
+
+    def finish_login(self, succeeded):
+        """登录有结果后发出暂存的消息，登录失败时丢弃"""
+        self.login_pending = False
+        held_messages, self.held_messages = self.held_messages, deque(maxlen=OFFLINE_QUEUE_LIMIT)
+        if succeeded:
+            for message in held_messages:
+                self.outgoing.put_nowait({'action': 'message', 'message': message})
+        elif held_messages:
+            self.emit('dropped', self.channel, {'reason': 'login_failed', 'count': len(held_messages)})
+
+    async def login(self, username, channel="public", password=None, password_hash=None, history=HISTORY_REPLAY):
+        """登录并等待结果，返回登录成功的事件；需要密码时抛出 PasswordRequired，被拒绝时抛出 ChatError"""
+        if password is not None:
+            password_hash = hash_password(password)
+        return self.check_reply(await self.request_login(username, channel, password_hash, history))
+
+    async def choose(self, channel, username=None, history=HISTORY_REPLAY):
+        """切换到 channel 并等待结果，返回切换成功的事件，被拒绝时抛出 ChatError"""
+        if username is not None:
+            self.username = username
+        request_id = next(self.request_ids)
+        self.send_request({
+            'action': 'choose',
+            'username': self.username,
+            'old_channel': self.channel,
+            'new_channel': channel,
+            'history': {'last': history},
+            'request_id': request_id
+        })
+        return self.check_reply(await self.wait_reply(request_id))
+
+    def send_nowait(self, message):
+        """发送聊天消息，不等待；登录完成前或断线期间先暂存，超出上限时丢弃最早的消息"""
+        if self.closing:
+            raise ConnectionError("客户端已关闭")
+        if self.login_pending or self.websocket is None:
+            if len(self.held_messages) == self.held_messages.maxlen:
+                self.emit('dropped', self.channel, {'reason': 'overflow', 'count': 1})
+            self.held_messages.append(message)
+        else:
+            self.outgoing.put_nowait({'action': 'message', 'message': message})
+
+    async def send(self, message):
+        """发送聊天消息，发送队列积压过多时等待发出后再返回"""
+        while self.websocket is not None and self.outgoing.qsize() >= SEND_QUEUE_LIMIT:
+            await self.outgoing.join()
+        self.send_nowait(message)
+
+    def list_users(self, channel_id):
+        """请求频道在线用户列表，结果以 user_list 事件返回"""
+        self.send_request({'action': 'list_command', 'channel_id': channel_id})
+
+    def presence(self):
+        """请求当前频道最近的成员变动，结果以 user_list 事件返回"""
+        self.send_request({'action': 'presence'})
+
+    def admin_command(self, command):
+        """发送管理员命令，结果以事件返回"""
+        self.send_request({'action': 'admin_command', 'command': command})
@@ -1,368 +1,563 @@
 import asyncio
+import atexit
+import codecs
 import websockets
-import json
+import os
 import threading
 import sys
 import random
 import string
-import hashlib
-from datetime import datetime
+from datetime import date, datetime
+from urllib.parse import quote
+from chat import AsyncChatClient, ChatError, EVICTION_NOTICES, OFFLINE_QUEUE_LIMIT
+from scrollback import ScrollbackStore, SCROLLBACK_PAGE_SIZE
+
+# 终端支持时由客户端自行处理按键和回显，刷新输出时保留正在输入的内容（Windows 等不支持时按行读取）
+try:
+    import termios
+except ImportError:
+    termios = None
 
 # 调试模式设置：1-使用默认服务器地址，0-需要手动输入服务器地址
 DEBUG = 0
 
-def hash_password(password):
-    """对密码进行哈希处理"""
-    return hashlib.sha256(password.encode('utf-8')).hexdigest()
+# 终端每秒最多刷新的次数，期间收到的消息合并到一次输出
+RENDER_FPS = 30
+
+# 每次刷新最多显示的聊天消息条数，超出时只显示最新的消息，较早的折叠为一行提示
+RENDER_MAX_MESSAGES = 20
+
+# 本地聊天记录的保存目录，按服务器地址和频道分子目录；为 None 时不保存
+SCROLLBACK_DIR = os.path.join(os.path.expanduser("~"), ".chat_scrollback")
+
+class Terminal:
+    """终端输出层：合并待显示的内容按帧率统一刷新，输入行始终保持在最下方
+
+    每次刷新只写一次标准输出：清除输入行，输出这段时间收到的内容，再重新显示提示符和正在输入的内容。
+    """
+
+    def __init__(self):
+        self.pending = []  # 等待显示的内容：(文本, 是否可折叠)
+        self.prompt = ""
+        self.input_text = ""  # 正在输入的内容，按行读取时为空
+        self.mask_input = False  # 是否以 * 显示正在输入的内容（输入密码时）
+        self.frame_handle = None
+        self.last_frame = 0
+
+    def write(self, text, collapsible=False):
+        """显示一段内容；短时间内大量到达时，可折叠的内容只显示最新的若干条"""
+        self.pending.append((text, collapsible))
+        self.schedule()
+
+    def set_prompt(self, prompt):
+        """设置输入提示符"""
+        if prompt != self.prompt:
+            self.prompt = prompt
+            self.schedule()
+
+    def set_input(self, text):
+        """更新正在输入的内容"""
+        self.input_text = text
+        self.schedule()
+
+    def schedule(self):
+        """安排下一次刷新，距上次刷新不足一帧时延后到下一帧"""
+        if self.frame_handle is None:
+            loop = asyncio.get_running_loop()
+            delay = max(0, self.last_frame + 1 / RENDER_FPS - loop.time())
+            self.frame_handle = loop.call_later(delay, self.render)
+
+    def render(self):
+        """刷新终端：输出等待显示的内容并重绘输入行"""
+        if self.frame_handle is not None:
+            self.frame_handle.cancel()
+            self.frame_handle = None
+        self.last_frame = asyncio.get_running_loop().time()
+
+        pending, self.pending = self.pending, []
+        collapsible_count = sum(1 for _, collapsible in pending if collapsible)
+        hidden = collapsible_count - RENDER_MAX_MESSAGES
+        output = ["\r\033[K"]
+        if hidden > 0:
+            output.append(f"\033[90m… 还有 {hidden} 条消息未显示\033[0m\n")
+        for text, collapsible in pending:
+            if collapsible and hidden > 0:
+                hidden -= 1
+                continue
+            output.append(text + "\n")
+        output.append(self.prompt)
+        output.append("*" * len(self.input_text) if self.mask_input else self.input_text)
+        sys.stdout.write("".join(output))
+        sys.stdout.flush()
+
+    def edit(self, text, lines):
+        """处理按键：编辑正在输入的内容，回车时把完成的一行放入 lines，Ctrl-D 时放入 None"""
+        buffer = self.input_text
+        escape = None  # 正在跳过的转义序列（方向键等）
+        for char in text:
+            if escape is not None:
+                # ESC [ 和 ESC O 开头的序列跳过到结束字符为止，其他转义只跳过一个字符
+                escape += char
+                if escape[1] not in '[O' or (len(escape) > 2 and '@' <= char <= '~'):
+                    escape = None
+                continue
+            if char in '\r\n':
+                # 已输入的内容留在屏幕上，密码不回显
+                self.write(self.prompt + ("*" * len(buffer) if self.mask_input else buffer))
+                lines.put_nowait(buffer)
+                buffer = ""
+            elif char in '\x7f\b':
+                buffer = buffer[:-1]
+            elif char == '\x15':  # Ctrl-U 清空输入
+                buffer = ""
+            elif char == '\x04':  # Ctrl-D 在空行时结束输入
+                if not buffer:
+                    lines.put_nowait(None)
+            elif char == '\x1b':
+                escape = char
+            elif char >= ' ':
+                buffer += char
+        self.set_input(buffer)
+
+    def close(self):
+        """立即输出剩余内容并换行"""
+        self.prompt = ""
+        self.input_text = ""
+        self.render()
+        sys.stdout.write("\n")
+        sys.stdout.flush()
 
 class ChatClient:
-    def __init__(self, server_address):
+    """终端聊天客户端：读取用户输入转为 AsyncChatClient 的调用，并显示收到的事件"""
+
+    def __init__(self, server_address, input_lines, terminal):
+        self.chat = AsyncChatClient(server_address)
         self.username = None
-        self.websocket = None
-        self.running = False
         self.current_channel = "public"  # 默认频道
-        self.loop = None
-        self.server_address = server_address
-        self.first_input = True  # 标记是否是第一次输入
-        self.joined = False  # 标记是否已加入频道
-        self.is_admin = False  # 是否为管理员
+        self.input_lines = input_lines  # 用户输入的行队列，由 open_input 创建
+        self.terminal = terminal
         self.waiting_for_password = False  # 是否正在等待输入密码
+        # 本地聊天记录，查找和翻页不经过服务器
+        self.scrollback = None
+        if SCROLLBACK_DIR:
+            self.scrollback = ScrollbackStore(os.path.join(SCROLLBACK_DIR, quote(server_address, safe='')))
 
     async def connect(self):
-        """连接到WebSocket服务器"""
-        self.running = True
-        self.loop = asyncio.get_running_loop()
-        
+        """连接到WebSocket服务器，连接断开后由 AsyncChatClient 自动重连"""
+        write = self.terminal.write
         try:
-            async with websockets.connect(f"ws://{self.server_address}") as websocket:
-                self.websocket = websocket
-                
-                # 启动消息接收协程
-                receive_task = asyncio.create_task(self.receive_messages())
-                
-                # 启动输入线程
-                input_thread = threading.Thread(target=self.input_loop, daemon=True)
-                input_thread.start()
-                
-                # 等待接收任务完成
-                await receive_task
-                
+            await self.chat.start()
         except ConnectionRefusedError:
-            print(f"无法连接到服务器 {self.server_address}，请确保服务器已启动")
+            write(f"无法连接到服务器 {self.chat.server_address}，请确保服务器已启动")
+            return
+        except websockets.exceptions.InvalidStatus as e:
+            # 服务器繁忙时以 503 拒绝连接，并在 Retry-After 中给出建议的等待时间
+            retry_after = e.response.headers.get("Retry-After")
+            if e.response.status_code == 503 and retry_after:
+                write(f"服务器繁忙，请 {retry_after} 秒后重试")
+            else:
+                write(f"连接被服务器拒绝: HTTP {e.response.status_code}")
+            return
         except Exception as e:
-            print(f"连接错误: {e}")
+            write(f"连接错误: {e}")
+            return
+
+        # 启动输入处理协程，在连接关闭前持续显示收到的事件
+        input_task = asyncio.create_task(self.input_loop())
+        try:
+            async for event in self.chat.events():
+                self.show_event(event)
         finally:
-            self.running = False
+            input_task.cancel()
+            if self.scrollback is not None:
+                self.scrollback.close()
 
-    async def receive_messages(self):
-        """接收并显示服务器发送的消息"""
-        while self.running and self.websocket:
-            try:
-                message = await self.websocket.recv()
-                data = json.loads(message)
-                
-                # 确保消息包含必要的字段
-                required_fields = ['type', 'channel', 'time']
-                for field in required_fields:
-                    if field not in data:
-                        data[field] = '' if field != 'time' else datetime.now().strftime("%H:%M:%S")
-                
-                # 清除输入提示
-                sys.stdout.write("\033[K")  # 清除当前行
-                
-                # 提取频道信息
-                channel = data['channel']
-                
-                # 处理管理员认证相关消息
-                if data['type'] == 'require_password':
-                    self.waiting_for_password = True
-                    print(f"\033[93m[{channel}] {data['message']}\033[0m")
-                    print(f"\033[93m请输入密码:\033[0m ", end="", flush=True)
-                    continue
-                
-                # 处理管理员登录成功和命令提示
-                if data['type'] == 'system' and 'admin_commands' in data:
-                    self.is_admin = True
-                    print(f"\033[90m[{channel}] [{data['time']}] 系统消息: {data['message']}\033[0m")
-                    print("\033[93m管理员可用命令:\033[0m")
-                    for cmd in data['admin_commands']:
-                        print(f"\033[93m  {cmd}\033[0m")
-                
-                # 根据消息类型显示不同格式
-                elif data['type'] == 'system':
-                    print(f"\033[90m[{channel}] [{data['time']}] 系统消息: {data['message']}\033[0m")
-                    
-                    # 如果是被踢出或清退，允许用户重新选择频道
-                    if any(msg in data['message'] for msg in ['已从频道被踢出', '该频道已被清退', '该频道被封禁']):
-                        self.current_channel = "public"  # 重置为默认频道
-                        self.joined = False
-                        print(f"\033[90m系统消息: 您可以使用 ::choose [频道ID] 命令重新加入其他频道\033[0m")
-                
-                elif data['type'] == 'message':
-                    username = data.get('username', '未知用户')
-                    msg_content = data.get('message', '')
-                    print(f"\033[94m[{channel}] [{data['time']}] {username}:\033[0m {msg_content}")
-                elif data['type'] == 'error':
-                    print(f"\033[91m[{channel}] 错误: {data['message']}\033[0m")
-                elif data['type'] == 'user_list':
-                    print(f"\033[90m[{channel}] [{data['time']}] 系统消息: {data['message']}\033[0m")
-                    print(f"\033[96m  {data['users']}\033[0m")
-                
-                # 更新当前频道
-                if data['type'] == 'system' and (data['message'].startswith('已切换到频道') or 
-                                               data['message'].startswith('成功加入频道')):
-                    self.current_channel = channel
-                    self.joined = True
-                
-                # 显示输入提示
-                if self.waiting_for_password:
-                    print(f"\033[93m请输入密码:\033[0m ", end="", flush=True)
-                else:
-                    print(f"\033[92m[{self.current_channel}] 你:\033[0m ", end="", flush=True)
-                
-            except websockets.exceptions.ConnectionClosed:
-                print("\n与服务器的连接已关闭")
-                break
-            except json.JSONDecodeError:
-                print("\n收到无效格式的消息")
-            except Exception as e:
-                print(f"\n接收消息错误: {e}")
+    def show_event(self, event):
+        """显示一个事件"""
+        write = self.terminal.write
+        channel = event.channel
+        message = event.get('message', '')
+        time_text = event.get('time') or datetime.now().strftime("%H:%M:%S")
+
+        # 连接状态变化
+        if event.type in ('connected', 'closed'):
+            return
+        if event.type == 'disconnected':
+            if event.code == 1013:
+                write(f"与服务器的连接已关闭: {event.reason}")
+            else:
+                write("与服务器的连接已关闭")
+            return
+        if event.type == 'reconnecting':
+            if event.error:
+                write(f"重新连接失败: {event.error}")
+            write(f"\033[90m系统消息: {event.delay:.1f} 秒后重新连接...\033[0m")
+            return
+
+        if event.type == 'dropped':
+            if event.reason == 'overflow':
+                write(f"\033[91m待发送的消息超过 {OFFLINE_QUEUE_LIMIT} 条，最早的消息已丢弃\033[0m")
+            else:
+                write(f"\033[91m登录未成功，{event.count} 条消息未发送\033[0m")
+        elif event.type == 'invalid':
+            write("收到无效格式的消息")
+
+        # 处理管理员认证相关消息
+        elif event.type == 'require_password':
+            self.waiting_for_password = True
+            write(f"\033[93m[{channel}] {message}\033[0m")
+
+        # 处理管理员登录成功和命令提示
+        elif event.type == 'system' and 'admin_commands' in event.data:
+            commands = "\n".join(f"\033[93m  {cmd}\033[0m" for cmd in event.admin_commands)
+            write(f"\033[90m[{channel}] [{time_text}] 系统消息: {message}\033[0m\n"
+                  f"\033[93m管理员可用命令:\033[0m\n{commands}")
+
+        # 根据消息类型显示不同格式
+        elif event.type == 'system':
+            write(f"\033[90m[{channel}] [{time_text}] 系统消息: {message}\033[0m")
+
+            # 如果是被踢出或清退，允许用户重新选择频道
+            if any(notice in message for notice in EVICTION_NOTICES):
+                self.current_channel = "public"  # 重置为默认频道
+                write(f"\033[90m系统消息: 您可以使用 ::choose [频道ID] 命令重新加入其他频道\033[0m")
+
+        # 聊天消息和成员变动在短时间内大量到达时可以折叠
+        elif event.type == 'message':
+            write(f"\033[94m[{channel}] [{time_text}] {event.get('username', '未知用户')}:\033[0m {message}",
+                  collapsible=True)
+            self.save_scrollback(channel, event.data)
+        elif event.type == 'presence':
+            write(f"\033[90m[{channel}] [{time_text}] 系统消息: {message}\033[0m", collapsible=True)
+        elif event.type in ('resumed', 'resume_failed'):
+            write(f"\033[90m[{channel}] [{time_text}] 系统消息: {message}\033[0m")
+        elif event.type == 'error':
+            write(f"\033[91m[{channel}] 错误: {message}\033[0m")
+        elif event.type == 'user_list':
+            write(f"\033[90m[{channel}] [{time_text}] 系统消息: {message}\033[0m\n\033[96m  {event.users}\033[0m")
+        elif event.type == 'history':
+            self.show_history(event)
+
+        # 登录、切换频道或恢复会话后更新当前频道和用户名
+        if self.chat.joined and self.chat.channel:
+            self.current_channel = self.chat.channel
+            self.username = self.chat.username
+
+        self.update_prompt()
+
+    def show_history(self, event):
+        """显示服务器回放的频道历史消息"""
+        frames = event.get('frames', [])
+        channel = event.channel
+        if not frames:
+            # 恢复会话时服务器无法确定错过了哪些消息
+            if event.get('truncated'):
+                self.terminal.write(f"\033[90m[{channel}] 断线期间的消息已不可用\033[0m")
+            return
+
+        lines = []
+        if event.get('truncated'):
+            lines.append(f"\033[90m[{channel}] 更早的历史消息已不可用\033[0m")
+        lines.append(f"\033[90m[{channel}] ----- 历史消息 ({len(frames)}) -----\033[0m")
+        for item in frames:
+            if item.get('type') == 'message':
+                self.save_scrollback(channel, item, replayed=True)
+                lines.append(f"\033[94m[{channel}] [{item.get('time', '')}] {item.get('username', '未知用户')}:\033[0m {item.get('message', '')}")
+            elif item.get('type') in ('system', 'presence'):
+                lines.append(f"\033[90m[{channel}] [{item.get('time', '')}] 系统消息: {item.get('message', '')}\033[0m")
+        lines.append(f"\033[90m[{channel}] ----- 以上为历史消息 -----\033[0m")
+        self.terminal.write("\n".join(lines))
+
+    def save_scrollback(self, channel, data, replayed=False):
+        """把聊天消息写入本地聊天记录，写入失败时停用本地记录"""
+        if self.scrollback is None:
+            return
+        record = {
+            'date': date.today().isoformat(),
+            'time': data.get('time', ''),
+            'username': data.get('username', ''),
+            'message': data.get('message', '')
+        }
+        try:
+            self.scrollback.channel(channel).record(record, replayed)
+        except OSError as e:
+            self.terminal.write(f"\033[91m本地聊天记录写入失败，已停用: {e}\033[0m")
+            self.scrollback = None
+
+    def format_record(self, channel, record):
+        """本地聊天记录中一条消息的显示文本"""
+        return (f"\033[94m[{channel}] [{record.get('date', '')} {record.get('time', '')}] "
+                f"{record.get('username') or '未知用户'}:\033[0m {record.get('message', '')}")
+
+    def show_search(self, query):
+        """在当前频道的本地聊天记录中查找并显示结果"""
+        channel = self.current_channel
+        results = self.scrollback.channel(channel).search(query)
+        if not results:
+            self.terminal.write(f"\033[90m[{channel}] 本地记录中没有包含 '{query}' 的消息\033[0m")
+            return
+        
+        # 最近的结果显示在最下方
+        lines = [f"\033[90m[{channel}] ----- 本地记录中包含 '{query}' 的消息 ({len(results)}) -----\033[0m"]
+        lines.extend(self.format_record(channel, record) for record in reversed(results))
+        lines.append(f"\033[90m[{channel}] ----- 以上为查找结果 -----\033[0m")
+        self.terminal.write("\n".join(lines))
+
+    def show_page(self, number):
+        """显示当前频道本地聊天记录的第 number 页，第 1 页为最近的记录"""
+        channel = self.current_channel
+        scrollback = self.scrollback.channel(channel)
+        page_count = (scrollback.count() + SCROLLBACK_PAGE_SIZE - 1) // SCROLLBACK_PAGE_SIZE
+        if page_count == 0:
+            self.terminal.write(f"\033[90m[{channel}] 本地记录中暂无消息\033[0m")
+            return
+        if number > page_count:
+            self.terminal.write(f"\033[91m错误: 本地记录共 {page_count} 页\033[0m")
+            return
+        
+        lines = [f"\033[90m[{channel}] ----- 本地记录 第 {number}/{page_count} 页 -----\033[0m"]
+        lines.extend(self.format_record(channel, record) for record in scrollback.page(number))
+        if number < page_count:
+            lines.append(f"\033[90m[{channel}] ----- 使用 ::scroll {number + 1} 查看更早的记录 -----\033[0m")
+        else:
+            lines.append(f"\033[90m[{channel}] ----- 已到最早的记录 -----\033[0m")
+        self.terminal.write("\n".join(lines))
 
     def generate_random_username(self):
         """生成5位随机字母数字组合的用户名"""
         letters_and_digits = string.ascii_letters + string.digits
         return ''.join(random.choice(letters_and_digits) for _ in range(5))
 
-    def input_loop(self):
-        """处理用户输入并发送消息"""
-        asyncio.set_event_loop(asyncio.new_event_loop())
-        loop = asyncio.get_event_loop()
-        
-        # 显示初始提示信息
-        print("\n===== 聊天提示 =====")
-        print("可直接发送消息（系统会自动分配用户名和频道）")
-        print("公共命令:")
-        print("::login [用户名] - 设置你的用户名")
-        print("::choose [频道ID] - 选择或切换聊天频道")
-        print("::list [频道id] - 查看指定频道在线用户")
-        print("exit 或 quit - 退出聊天")
-        
-        # 初始只显示公共命令，管理员命令在登录后显示
-        print("======================")
-        print(f"\033[92m[{self.current_channel}] 你:\033[0m ", end="", flush=True)
-        
-        while self.running:
+    def update_prompt(self):
+        """按当前频道和是否在输入密码更新输入提示"""
+        self.terminal.mask_input = self.waiting_for_password
+        if self.waiting_for_password:
+            self.terminal.set_prompt(f"\033[93m请输入密码:\033[0m ")
+        else:
+            self.terminal.set_prompt(f"\033[92m[{self.current_channel}] 你:\033[0m ")
+
+    async def input_loop(self):
+        """在主事件循环中逐行读取用户输入并处理"""
+        # 显示初始提示信息，初始只显示公共命令，管理员命令在登录后显示
+        self.terminal.write("\n".join([
+            "",
+            "===== 聊天提示 =====",
+            "可直接发送消息（系统会自动分配用户名和频道）",
+            "公共命令:",
+            "::login [用户名] - 设置你的用户名",
+            "::choose [频道ID] - 选择或切换聊天频道",
+            "::list [频道id] - 查看指定频道在线用户",
+            "::who - 查看当前频道最近加入和离开的用户",
+            "::search [关键词] - 在本地聊天记录中查找当前频道的消息",
+            "::scroll [页码] - 翻看当前频道的本地聊天记录（第 1 页为最近的记录）",
+            "exit 或 quit - 退出聊天",
+            "======================"
+        ]))
+        self.update_prompt()
+
+        while True:
+            message = await self.input_lines.get()
+            if message is None:
+                break
+
             try:
-                message = input()
-                
-                if message.lower() in ['exit', 'quit']:
-                    self.running = False
-                    if self.websocket:
-                        loop.run_until_complete(
-                            self.websocket.send(json.dumps({'action': 'leave'}))
-                        )
-                        loop.run_until_complete(self.websocket.close())
-                    print("已退出聊天")
+                if not await self.handle_input(message):
                     break
-                
-                # 处理密码输入
-                if self.waiting_for_password:
-                    password = message.strip()
-                    if password:
-                        password_hash = hash_password(password)
-                        
-                        loop.run_until_complete(
-                            self.websocket.send(json.dumps({
-                                'action': 'login',
-                                'username': self.username,
-                                'channel': self.current_channel,
-                                'password_hash': password_hash
-                            }))
-                        )
-                        self.waiting_for_password = False
-                    
-                    print(f"\033[92m[{self.current_channel}] 你:\033[0m ", end="", flush=True)
-                    continue
-                
-                # 处理查看频道用户命令
-                if message.startswith('::list '):
-                    parts = message.split()
-                    if len(parts) < 2:
-                        print(f"\033[91m错误: 命令格式应为 ::list [频道id]\033[0m")
-                        print(f"\033[92m[{self.current_channel}] 你:\033[0m ", end="", flush=True)
-                        continue
-                        
-                    channel_id = parts[1]
-                    loop.run_until_complete(
-                        self.websocket.send(json.dumps({
-                            'action': 'list_command',
-                            'channel_id': channel_id
-                        }))
-                    )
-                    print(f"\033[92m[{self.current_channel}] 你:\033[0m ", end="", flush=True)
-                    self.first_input = False
-                    continue
-                
-                # 处理管理员命令
-                if self.is_admin:
-                    # 处理查看全服用户命令
-                    if message == '::lists':
-                        loop.run_until_complete(
-                            self.websocket.send(json.dumps({
-                                'action': 'admin_command',
-                                'command': message
-                            }))
-                        )
-                        print(f"\033[92m[{self.current_channel}] 你:\033[0m ", end="", flush=True)
-                        self.first_input = False
-                        continue
-                    
-                    # 处理私信命令
-                    if message.startswith('::say '):
-                        loop.run_until_complete(
-                            self.websocket.send(json.dumps({
-                                'action': 'admin_command',
-                                'command': message
-                            }))
-                        )
-                        print(f"\033[92m[{self.current_channel}] 你:\033[0m ", end="", flush=True)
-                        self.first_input = False
-                        continue
-                    
-                    # 处理其他管理员命令
-                    if message.startswith(('::kicks', '::kick', '::closes', '::close')):
-                        loop.run_until_complete(
-                            self.websocket.send(json.dumps({
-                                'action': 'admin_command',
-                                'command': message
-                            }))
-                        )
-                        print(f"\033[92m[{self.current_channel}] 你:\033[0m ", end="", flush=True)
-                        self.first_input = False
-                        continue
-                else:
-                    # 非管理员尝试使用管理员命令
-                    if message.startswith(('::lists', '::say', '::kicks', '::kick', '::closes', '::close')):
-                        print(f"\033[91m错误: 你没有权限执行此命令\033[0m")
-                        print(f"\033[92m[{self.current_channel}] 你:\033[0m ", end="", flush=True)
-                        continue
-                
-                # 处理频道切换命令
-                if message.startswith('::choose '):
-                    new_channel = message[len('::choose '):].strip()
-                    if new_channel and new_channel != self.current_channel:
-                        if not self.username:
-                            self.username = self.generate_random_username()
-                            print(f"\033[90m系统消息: 未设置用户名，已自动分配: {self.username}\033[0m")
-                        
-                        loop.run_until_complete(
-                            self.websocket.send(json.dumps({
-                                'action': 'choose',
-                                'username': self.username,
-                                'old_channel': self.current_channel,
-                                'new_channel': new_channel
-                            }))
-                        )
-                    print(f"\033[92m[{self.current_channel}] 你:\033[0m ", end="", flush=True)
-                    self.first_input = False
-                    continue
-                
-                # 处理登录命令
-                if message.startswith('::login '):
-                    new_username = message[len('::login '):].strip()
-                    if new_username and new_username != self.username:
-                        self.username = new_username
-                        
-                        # 发送登录信息
-                        login_data = {
-                            'action': 'login',
-                            'username': self.username,
-                            'channel': self.current_channel
-                        }
-                        
-                        loop.run_until_complete(
-                            self.websocket.send(json.dumps(login_data))
-                        )
-                        print(f"\033[90m系统消息: 已设置用户名为: {self.username}\033[0m")
-                    
-                    print(f"\033[92m[{self.current_channel}] 你:\033[0m ", end="", flush=True)
-                    self.first_input = False
-                    continue
-                
-                # 处理普通消息
-                message = message.strip()
-                if message:
-                    # 第一次输入且没有用户名，自动生成
-                    if self.first_input and not self.username:
-                        self.username = self.generate_random_username()
-                        print(f"\033[90m系统消息: 未设置用户名，已自动分配: {self.username}\033[0m")
-                        
-                        # 自动加入默认频道
-                        if not self.joined:
-                            print(f"\033[90m系统消息: 未选择频道，已自动加入默认频道: {self.current_channel}\033[0m")
-                            loop.run_until_complete(
-                                self.websocket.send(json.dumps({
-                                    'action': 'login',
-                                    'username': self.username,
-                                    'channel': self.current_channel
-                                }))
-                            )
-                            self.joined = True
-                    
-                    # 发送消息
-                    if self.joined and self.websocket:
-                        loop.run_until_complete(
-                            self.websocket.send(json.dumps({
-                                'action': 'message',
-                                'message': message
-                            }))
-                        )
-                    elif self.websocket:
-                        self.joined = True
-                        loop.run_until_complete(
-                            self.websocket.send(json.dumps({
-                                'action': 'login',
-                                'username': self.username,
-                                'channel': self.current_channel
-                            }))
-                        )
-                        loop.run_until_complete(asyncio.sleep(0.1))
-                        loop.run_until_complete(
-                            self.websocket.send(json.dumps({
-                                'action': 'message',
-                                'message': message
-                            }))
-                        )
-                
-                # 更新输入提示
-                print(f"\033[92m[{self.current_channel}] 你:\033[0m ", end="", flush=True)
-                self.first_input = False
-                
-            except EOFError:
-                break
+            except ConnectionError:
+                self.terminal.write(f"\033[91m错误: 正在重新连接服务器，请求未发送\033[0m")
             except Exception as e:
-                print(f"输入错误: {e}")
-                print(f"\033[92m[{self.current_channel}] 你:\033[0m ", end="", flush=True)
-        loop.close()
+                self.terminal.write(f"输入错误: {e}")
+            self.update_prompt()
+
+    async def login(self, password=None):
+        """以当前用户名登录当前频道，返回是否成功；失败原因由服务器消息显示"""
+        try:
+            await self.chat.login(self.username, self.current_channel, password=password)
+            return True
+        except ChatError:
+            return False
+
+    async def handle_input(self, message):
+        """处理一行用户输入，返回 False 表示退出聊天"""
+        write = self.terminal.write
+        if message.lower() in ['exit', 'quit']:
+            write("已退出聊天")
+            await self.chat.close()
+            return False
+
+        # 处理密码输入
+        if self.waiting_for_password:
+            password = message.strip()
+            self.waiting_for_password = False
+            self.update_prompt()
+            if password:
+                await self.login(password)
+            return True
+
+        # 处理查看频道用户命令
+        if message.startswith('::list '):
+            parts = message.split()
+            if len(parts) < 2:
+                write(f"\033[91m错误: 命令格式应为 ::list [频道id]\033[0m")
+            else:
+                self.chat.list_users(parts[1])
+            return True
+
+        # 处理本地聊天记录的查找和翻页命令，不经过服务器
+        if message.startswith('::search') or message.startswith('::scroll'):
+            command, _, argument = message.partition(' ')
+            argument = argument.strip()
+            if self.scrollback is None:
+                write(f"\033[91m错误: 本地聊天记录不可用\033[0m")
+            elif command == '::search' and argument:
+                self.show_search(argument)
+            elif command == '::scroll' and (not argument or argument.isdigit() and int(argument) > 0):
+                self.show_page(int(argument) if argument else 1)
+            else:
+                write(f"\033[91m错误: 命令格式应为 ::search [关键词] 或 ::scroll [页码]\033[0m")
+            return True
+
+        # 处理查看最近成员变动命令
+        if message.strip() == '::who':
+            self.chat.presence()
+            return True
+
+        # 管理员命令原样交给服务器处理
+        if message == '::lists' or message.startswith(('::lists ', '::say ', '::kicks', '::kick',
+                                                        '::closes', '::close')):
+            if self.chat.is_admin:
+                self.chat.admin_command(message)
+            else:
+                write(f"\033[91m错误: 你没有权限执行此命令\033[0m")
+            return True
+
+        # 处理频道切换命令
+        if message.startswith('::choose '):
+            new_channel = message[len('::choose '):].strip()
+            if new_channel and new_channel != self.current_channel:
+                if not self.username:
+                    self.username = self.generate_random_username()
+                    write(f"\033[90m系统消息: 未设置用户名，已自动分配: {self.username}\033[0m")
+                try:
+                    await self.chat.choose(new_channel, self.username)
+                except ChatError:
+                    pass
+            return True
+
+        # 处理登录命令
+        if message.startswith('::login '):
+            new_username = message[len('::login '):].strip()
+            if new_username and new_username != self.username:
+                self.username = new_username
+                write(f"\033[90m系统消息: 已设置用户名为: {self.username}\033[0m")
+                await self.login()
+            return True
+
+        # 处理普通消息
+        message = message.strip()
+        if message:
+            # 没有用户名时自动生成
+            if not self.username:
+                self.username = self.generate_random_username()
+                write(f"\033[90m系统消息: 未设置用户名，已自动分配: {self.username}\033[0m")
+
+            # 未加入频道时先登录，登录成功后再发送消息
+            if not self.chat.joined:
+                write(f"\033[90m系统消息: 未选择频道，已自动加入默认频道: {self.current_channel}\033[0m")
+                if not await self.login():
+                    return True
+            await self.chat.send(message)
+        return True
+
+def open_input(loop, terminal):
+    """在事件循环中逐行读取标准输入，返回行队列，读到输入结束时放入 None
+
+    标准输入是终端时关闭终端的行缓冲和回显，由 terminal 处理按键并显示正在输入的内容；
+    否则由事件循环监听可读事件按行读取。事件循环不支持时（Windows 或标准输入重定向自普通文件）
+    改由后台线程读取，读到的行仍交给主事件循环处理。
+    """
+    lines = asyncio.Queue()
+    try:
+        fd = sys.stdin.fileno()
+        decoder = codecs.getincrementaldecoder(sys.stdin.encoding or 'utf-8')(errors='replace')
+        pending = []  # 尚未读到换行符的部分
+
+        if termios is not None and os.isatty(fd):
+            saved_mode = termios.tcgetattr(fd)
+            mode = termios.tcgetattr(fd)
+            mode[3] &= ~(termios.ICANON | termios.ECHO)
+            mode[6][termios.VMIN] = 1
+            mode[6][termios.VTIME] = 0
+            termios.tcsetattr(fd, termios.TCSADRAIN, mode)
+            atexit.register(termios.tcsetattr, fd, termios.TCSADRAIN, saved_mode)
+
+            def on_keys():
+                data = os.read(fd, 4096)
+                if not data:
+                    loop.remove_reader(fd)
+                    lines.put_nowait(None)
+                    return
+                terminal.edit(decoder.decode(data), lines)
+
+            loop.add_reader(fd, on_keys)
+            return lines
+
+        def on_readable():
+            data = os.read(fd, 65536)
+            if not data:
+                loop.remove_reader(fd)
+                if pending:
+                    lines.put_nowait(''.join(pending))
+                lines.put_nowait(None)
+                return
+            text = decoder.decode(data)
+            *complete, rest = text.split('\n')
+            for line in complete:
+                pending.append(line)
+                lines.put_nowait(''.join(pending).rstrip('\r'))
+                pending.clear()
+            if rest:
+                pending.append(rest)
+
+        loop.add_reader(fd, on_readable)
+    except (NotImplementedError, OSError, ValueError):
+        def read_lines():
+            for line in iter(sys.stdin.readline, ''):
+                loop.call_soon_threadsafe(lines.put_nowait, line.rstrip('\r\n'))
+            loop.call_soon_threadsafe(lines.put_nowait, None)
+
+        threading.Thread(target=read_lines, daemon=True).start()
+    return lines
+
 
 async def main():
-    print("=== WebSocket 聊天客户端 ===")
-    
-    if DEBUG:
-        server_address = "localhost:8765"
-        print(f"DEBUG模式启用，使用默认服务器地址: {server_address}")
-    else:
-        server_address = input("请输入服务器地址(格式: ip:端口): ")
-        if ":" not in server_address:
-            print("地址格式不正确，应使用 ip:端口 格式")
-            return
-    
-    client = ChatClient(server_address)
-    await client.connect()
+    terminal = Terminal()
+    terminal.write("=== WebSocket 聊天客户端 ===")
+
+    # 所有输入都从同一个行队列读取，避免阻塞式读取预先取走后续输入
+    input_lines = open_input(asyncio.get_running_loop(), terminal)
+
+    try:
+        if DEBUG:
+            server_address = "localhost:8765"
+            terminal.write(f"DEBUG模式启用，使用默认服务器地址: {server_address}")
+        else:
+            terminal.set_prompt("请输入服务器地址(格式: ip:端口): ")
+            server_address = await input_lines.get()
+            terminal.set_prompt("")
+            if server_address is None:
+                return
+            if ":" not in server_address:
+                terminal.write("地址格式不正确，应使用 ip:端口 格式")
+                return
+
+        client = ChatClient(server_address, input_lines, terminal)
+        await client.connect()
+    finally:
+        terminal.close()
 
 if __name__ == "__main__":
     try:
         asyncio.run(main())
     except KeyboardInterrupt:
         print("\n客户端已关闭")
-    
\ No newline at end of file
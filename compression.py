@@ -0,0 +1,83 @@
+import zlib
+from collections import OrderedDict
+from websockets.extensions.permessage_deflate import (
+    PerMessageDeflate,
+    ServerPerMessageDeflateFactory,
+)
+from websockets.frames import CTRL_OPCODES, Frame, Opcode
+
+# 登记为共享的广播消息最多保留的条数，超出后最早登记的消息按普通消息压缩
+SHARED_FRAME_LIMIT = 1024
+
+# 共享的广播消息：{消息内容: {压缩窗口位数: 压缩结果}}，值为 None 表示该消息不压缩
+shared_frames = OrderedDict()
+
+def share_frame(payload, compress=True):
+    """登记一条要发给多个连接的消息，compress 为 False 时所有连接都不压缩它
+
+    登记的消息在不保留压缩上下文的连接上只压缩一次，压缩结果由相同窗口大小的连接共用。
+    消息内容必须是同一个 bytes 对象，查找时直接命中，不需要重新计算哈希。
+    """
+    shared_frames[payload] = {} if compress else None
+    while len(shared_frames) > SHARED_FRAME_LIMIT:
+        shared_frames.popitem(last=False)
+
+class ChatDeflate(PerMessageDeflate):
+    """带大小阈值和共享压缩结果的 permessage-deflate
+
+    小于阈值的消息直接发送，不压缩（协议允许逐条消息选择是否压缩，对端按 RSV1 位判断）。
+    不保留压缩上下文时每条消息的压缩结果只取决于消息内容和窗口大小，登记过的广播消息只压缩一次。
+    """
+
+    def __init__(self, extension, min_size):
+        super().__init__(
+            extension.remote_no_context_takeover,
+            extension.local_no_context_takeover,
+            extension.remote_max_window_bits,
+            extension.local_max_window_bits,
+            extension.compress_settings,
+        )
+        self.min_size = min_size
+
+    def encode(self, frame):
+        # 控制帧和分片消息按默认方式处理
+        if frame.opcode in CTRL_OPCODES or frame.opcode is Opcode.CONT or not frame.fin:
+            return super().encode(frame)
+
+        if len(frame.data) < self.min_size:
+            return frame
+
+        shared = shared_frames.get(frame.data, False)  # False 表示未登记
+        if shared is None:
+            return frame
+        if shared is False or not self.local_no_context_takeover:
+            return super().encode(frame)
+
+        compressed = shared.get(self.local_max_window_bits)
+        if compressed is None:
+            encoder = zlib.compressobj(wbits=-self.local_max_window_bits, **self.compress_settings)
+            # 去掉同步刷新末尾固定的 4 字节空块，与逐条压缩的结果相同
+            compressed = (encoder.compress(frame.data) + encoder.flush(zlib.Z_SYNC_FLUSH))[:-4]
+            shared[self.local_max_window_bits] = compressed
+        return Frame(frame.opcode, compressed, frame.fin, True, frame.rsv2, frame.rsv3)
+
+class ChatDeflateFactory(ServerPerMessageDeflateFactory):
+    """协商 permessage-deflate，并为每个连接创建 ChatDeflate"""
+
+    def __init__(self, min_size, **kwargs):
+        super().__init__(**kwargs)
+        self.min_size = min_size
+
+    def process_request_params(self, params, accepted_extensions):
+        response_params, extension = super().process_request_params(params, accepted_extensions)
+        return response_params, ChatDeflate(extension, self.min_size)
+
+def deflate_extensions(window_bits, memory_level, min_size, shared):
+    """按配置创建服务器端压缩扩展，shared 为 True 时不保留压缩上下文，使广播消息可以只压缩一次"""
+    return [ChatDeflateFactory(
+        min_size,
+        server_no_context_takeover=shared,
+        server_max_window_bits=window_bits,
+        client_max_window_bits=window_bits,
+        compress_settings={"memLevel": memory_level},
+    )]
@@ -0,0 +1,124 @@
+import asyncio
+from bisect import bisect_left
+
+# 延迟直方图的默认分桶上界（秒）
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5)
+
+# 读取 HTTP 请求头的长度上限
+METRICS_REQUEST_LIMIT = 8192
+
+# 所有已注册的指标，按注册顺序输出
+registry = []
+
+def format_labels(label_name, label_value):
+    """格式化 Prometheus 标签"""
+    escaped = str(label_value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return f'{{{label_name}="{escaped}"}}'
+
+class Counter:
+    """只增不减的计数器，可按一个标签分组
+
+    服务器在单个事件循环线程中运行，计数直接累加，不需要加锁。
+    """
+
+    def __init__(self, name, description, label_name=None):
+        self.name = name
+        self.description = description
+        self.label_name = label_name
+        self.value = 0  # 无标签时的计数
+        self.values = {}  # 有标签时的计数：{标签值: 计数}
+        registry.append(self)
+
+    def inc(self, label_value=None):
+        """计数加一"""
+        if self.label_name is None:
+            self.value += 1
+        else:
+            self.values[label_value] = self.values.get(label_value, 0) + 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} counter"]
+        if self.label_name is None:
+            lines.append(f"{self.name} {self.value}")
+        else:
+            lines.extend(f"{self.name}{format_labels(self.label_name, label_value)} {value}"
+                         for label_value, value in self.values.items())
+        return lines
+
+class Gauge:
+    """抓取时才计算的瞬时值，collect 返回数值或 {标签值: 数值}"""
+
+    def __init__(self, name, description, collect, label_name=None):
+        self.name = name
+        self.description = description
+        self.collect = collect
+        self.label_name = label_name
+        registry.append(self)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} gauge"]
+        if self.label_name is None:
+            lines.append(f"{self.name} {self.collect()}")
+        else:
+            lines.extend(f"{self.name}{format_labels(self.label_name, label_value)} {value}"
+                         for label_value, value in self.collect().items())
+        return lines
+
+class Histogram:
+    """预先分桶的直方图，记录时只更新计数，不分配新对象"""
+
+    def __init__(self, name, description, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.description = description
+        self.bounds = buckets
+        self.counts = [0] * (len(buckets) + 1)  # 最后一个桶对应 +Inf
+        self.sum = 0.0
+        self.count = 0
+        registry.append(self)
+
+    def observe(self, value):
+        """记录一个观测值"""
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} histogram"]
+        cumulative = 0
+        for bound, count in zip(self.bounds, self.counts):
+            cumulative += count
+            lines.append(f'{self.name}_bucket{{le="{bound}"}} {cumulative}')
+        lines.append(f'{self.name}_bucket{{le="+Inf"}} {self.count}')
+        lines.append(f"{self.name}_sum {self.sum}")
+        lines.append(f"{self.name}_count {self.count}")
+        return lines
+
+def render_metrics():
+    """以 Prometheus 文本格式输出所有指标"""
+    lines = []
+    for metric in registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+async def handle_metrics_request(reader, writer):
+    """处理一次 HTTP 请求，GET /metrics 返回指标，其余路径返回 404"""
+    try:
+        request = await reader.readuntil(b"\r\n\r\n")
+        request_line = request.split(b"\r\n", 1)[0].split()
+        if len(request_line) >= 2 and request_line[0] == b"GET" and request_line[1].split(b"?")[0] == b"/metrics":
+            status, body = "200 OK", render_metrics().encode('utf-8')
+        else:
+            status, body = "404 Not Found", b"not found\n"
+        writer.write(f"HTTP/1.1 {status}\r\n"
+                     "Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                     f"Content-Length: {len(body)}\r\n"
+                     "Connection: close\r\n\r\n".encode('utf-8') + body)
+        await writer.drain()
+    except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+async def serve_metrics(host, port):
+    """在本地 HTTP 端口上提供运行指标"""
+    return await asyncio.start_server(handle_metrics_request, host, port, limit=METRICS_REQUEST_LIMIT)
@@ -0,0 +1,79 @@
+import os
+import signal
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+
+# 每次采样的持续时间（秒）
+PROFILE_DURATION = 10
+
+# 采样间隔（秒）
+PROFILE_INTERVAL = 0.005
+
+# 采样结束后输出到日志的最热调用栈数量
+PROFILE_TOP_STACKS = 10
+
+def frame_label(frame):
+    """调用栈中一层的名称：函数名 (文件:首行号)"""
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+class SamplingProfiler:
+    """在后台线程中定时采样目标线程的调用栈，结束后以折叠栈格式写入文件（可直接生成火焰图）
+
+    采样只读取目标线程当前的栈帧，不挂钩每次函数调用，对被采样的事件循环几乎没有额外开销。
+    """
+
+    def __init__(self, thread_id, duration=PROFILE_DURATION, interval=PROFILE_INTERVAL):
+        self.thread_id = thread_id
+        self.duration = duration
+        self.interval = interval
+        self.thread = None
+
+    def start(self):
+        """开始一次采样，已有采样在进行时返回 False"""
+        if self.thread is not None and self.thread.is_alive():
+            return False
+        self.thread = threading.Thread(target=self.run, name="sampling-profiler", daemon=True)
+        self.thread.start()
+        return True
+
+    def run(self):
+        """采样线程：按间隔记录目标线程的调用栈，结束后写出结果"""
+        samples = Counter()
+        deadline = time.monotonic() + self.duration
+        while time.monotonic() < deadline:
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                stack.append(frame_label(frame))
+                frame = frame.f_back
+            if stack:
+                samples[";".join(reversed(stack))] += 1
+            time.sleep(self.interval)
+
+        path = os.path.join(tempfile.gettempdir(), f"chat-profile-{os.getpid()}-{int(time.time())}.txt")
+        with open(path, "w", encoding="utf-8") as output:
+            for stack, count in samples.most_common():
+                output.write(f"{stack} {count}\n")
+
+        total = sum(samples.values())
+        print(f"采样分析完成，共 {total} 个样本，已写入 {path}")
+        for stack, count in samples.most_common(PROFILE_TOP_STACKS):
+            print(f"  {count / total:6.1%}  {stack.rsplit(';', 1)[-1]}")
+
+def install_profile_signal(loop):
+    """收到 SIGUSR1 时对事件循环线程进行一次采样分析，不需要重启服务器"""
+    if not hasattr(signal, "SIGUSR1"):
+        return
+    profiler = SamplingProfiler(threading.get_ident())
+
+    def on_signal():
+        if profiler.start():
+            print(f"收到 SIGUSR1，开始采样分析 {profiler.duration} 秒 (pid {os.getpid()})")
+        else:
+            print("采样分析正在进行中")
+
+    loop.add_signal_handler(signal.SIGUSR1, on_signal)
@@ -0,0 +1,260 @@
+import json
+import time
+from functools import lru_cache
+
+# 安装了 orjson 时使用它编解码 JSON，否则使用标准库
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# 各类客户端请求允许的字段及其类型，解码时一次遍历完成校验；未列出的字段不做检查
+ACTION_SCHEMAS = {
+    "login": {"username": str, "channel": str, "password_hash": str, "history": dict, "request_id": int},
+    "choose": {"username": str, "old_channel": str, "new_channel": str, "history": dict, "request_id": int},
+    "resume": {"resume_token": str, "history": dict},
+    "list_command": {"channel_id": str},
+    "presence": {},
+    "admin_command": {"command": str},
+    "message": {"message": str},
+    "leave": {}
+}
+
+# 二进制编码使用的 WebSocket 子协议名，客户端未提供时使用 JSON 文本
+BINARY_SUBPROTOCOL = "chat.binary.v1"
+
+# 二进制编码的消息类型编号；0 表示无法紧凑编码，其后为完整的 JSON
+BINARY_TYPES = ("message", "system", "presence", "error", "user_list", "history",
+                "require_password", "resumed", "resume_failed", "channels")
+
+# 二进制编码的字段：(字段名, 取值类型)，编号为在元组中的位置
+BINARY_FIELDS = (
+    ("channel", "channel"),
+    ("time", "time"),
+    ("seq", "int"),
+    ("username", "str"),
+    ("message", "str"),
+    ("users", "str"),
+    ("resume_token", "str"),
+    ("joined", "int"),
+    ("left", "int"),
+    ("is_admin", "bool"),
+    ("last_seq", "int"),
+    ("truncated", "bool"),
+    ("frames", "frames"),
+    ("admin_commands", "strs"),
+    ("channels", "strs"),
+    ("request_id", "int")
+)
+
+# 固定响应的编码缓存条数
+STATIC_FRAME_CACHE_SIZE = 4096
+
+class ProtocolError(Exception):
+    """客户端请求格式错误"""
+
+if orjson is not None:
+    def loads(data):
+        """解码 JSON"""
+        return orjson.loads(data)
+
+    def dumps(value):
+        """编码为 JSON 字符串"""
+        return orjson.dumps(value).decode('utf-8')
+else:
+    loads = json.loads
+    dumps = json.dumps
+
+def decode_request(message):
+    """解码并校验客户端请求，返回 (请求类型, 请求数据)，格式不正确时抛出 ProtocolError"""
+    try:
+        data = loads(message)
+    except ValueError:
+        raise ProtocolError("不是有效的 JSON")
+    if not isinstance(data, dict):
+        raise ProtocolError("请求必须是 JSON 对象")
+
+    action = data.get("action")
+    schema = ACTION_SCHEMAS.get(action) if isinstance(action, str) else None
+    if schema is None:
+        raise ProtocolError(f"未知的请求类型 '{action}'")
+
+    for field, expected_type in schema.items():
+        value = data.get(field)
+        if value is not None and not isinstance(value, expected_type):
+            raise ProtocolError(f"字段 '{field}' 的类型不正确")
+    return action, data
+
+@lru_cache(maxsize=STATIC_FRAME_CACHE_SIZE)
+def static_frame(message_type, channel, message):
+    """编码只含类型、频道和文本的响应，相同参数只编码一次"""
+    return dumps({"type": message_type, "channel": channel, "message": message})
+
+# 按秒缓存的当前时间文本
+clock_second = None
+clock_text = ""
+
+def current_time():
+    """返回当前时间的 "时:分:秒" 文本，每秒最多格式化一次"""
+    global clock_second, clock_text
+    now = int(time.time())
+    if now != clock_second:
+        clock_second = now
+        clock_text = time.strftime("%H:%M:%S", time.localtime(now))
+    return clock_text
+
+def write_varint(buffer, value):
+    """以 LEB128 变长格式写入非负整数"""
+    while value > 0x7f:
+        buffer.append((value & 0x7f) | 0x80)
+        value >>= 7
+    buffer.append(value)
+
+def read_varint(data, position):
+    """读取 LEB128 变长整数，返回 (数值, 新位置)"""
+    value = 0
+    shift = 0
+    while True:
+        byte = data[position]
+        position += 1
+        value |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return value, position
+        shift += 7
+
+def write_text(buffer, text):
+    """写入带长度前缀的 UTF-8 文本"""
+    encoded = text.encode('utf-8')
+    write_varint(buffer, len(encoded))
+    buffer += encoded
+
+def read_text(data, position):
+    """读取带长度前缀的 UTF-8 文本，返回 (文本, 新位置)"""
+    length, position = read_varint(data, position)
+    return data[position:position + length].decode('utf-8'), position + length
+
+class BinaryCodec:
+    """紧凑二进制消息编码
+
+    格式：1 字节类型编号，随后依次为 1 字节字段编号和字段值。整数用变长编码，
+    频道用频道表中的编号（0 表示随后为频道名文本），"时:分:秒" 编码为当天的秒数。
+    含有无法紧凑编码的内容时，类型编号为 0，其后直接是 JSON 文本。
+    """
+
+    def __init__(self, channel_names=()):
+        self.set_channels(channel_names)
+
+    def set_channels(self, channel_names):
+        """设置频道表，双方需使用相同的频道表"""
+        self.channel_names = list(channel_names)
+        self.channel_ids = {name: index + 1 for index, name in enumerate(self.channel_names)}
+
+    def encode(self, message_data):
+        """编码一条消息"""
+        type_code = BINARY_TYPE_CODES.get(message_data.get("type"))
+        if type_code is not None:
+            buffer = bytearray((type_code,))
+            if self.write_fields(buffer, message_data):
+                return bytes(buffer)
+        return b"\x00" + dumps(message_data).encode('utf-8')
+
+    def encode_json(self, message_json):
+        """将已编码的 JSON 消息转为二进制编码"""
+        return self.encode(loads(message_json))
+
+    def write_fields(self, buffer, message_data):
+        """写入除类型外的所有字段，遇到无法紧凑编码的内容时返回 False"""
+        for key, value in message_data.items():
+            if key == "type":
+                continue
+            field = BINARY_FIELD_CODES.get(key)
+            if field is None:
+                return False
+            field_code, kind = field
+            buffer.append(field_code)
+
+            if kind == "str":
+                if not isinstance(value, str):
+                    return False
+                write_text(buffer, value)
+            elif kind == "int":
+                if type(value) is not int or value < 0:
+                    return False
+                write_varint(buffer, value)
+            elif kind == "bool":
+                if not isinstance(value, bool):
+                    return False
+                buffer.append(value)
+            elif kind == "channel":
+                if not isinstance(value, str):
+                    return False
+                channel_id = self.channel_ids.get(value, 0)
+                write_varint(buffer, channel_id)
+                if channel_id == 0:
+                    write_text(buffer, value)
+            elif kind == "time":
+                if not isinstance(value, str) or len(value) != 8 or not value[:2].isdigit() \
+                        or not value[3:5].isdigit() or not value[6:].isdigit():
+                    return False
+                write_varint(buffer, int(value[:2]) * 3600 + int(value[3:5]) * 60 + int(value[6:]))
+            elif kind == "strs":
+                if not isinstance(value, list) or not all(isinstance(item, str) for item in value):
+                    return False
+                write_varint(buffer, len(value))
+                for item in value:
+                    write_text(buffer, item)
+            else:  # frames
+                if not isinstance(value, list) or not all(isinstance(item, dict) for item in value):
+                    return False
+                write_varint(buffer, len(value))
+                for item in value:
+                    encoded = self.encode(item)
+                    write_varint(buffer, len(encoded))
+                    buffer += encoded
+        return True
+
+    def decode(self, data):
+        """解码一条消息"""
+        if data[0] == 0:
+            return loads(data[1:])
+
+        message_data = {"type": BINARY_TYPES[data[0] - 1]}
+        position = 1
+        while position < len(data):
+            key, kind = BINARY_FIELDS[data[position]]
+            position += 1
+            if kind == "str":
+                value, position = read_text(data, position)
+            elif kind == "int":
+                value, position = read_varint(data, position)
+            elif kind == "bool":
+                value = bool(data[position])
+                position += 1
+            elif kind == "channel":
+                channel_id, position = read_varint(data, position)
+                if channel_id:
+                    value = self.channel_names[channel_id - 1]
+                else:
+                    value, position = read_text(data, position)
+            elif kind == "time":
+                seconds, position = read_varint(data, position)
+                value = f"{seconds // 3600:02d}:{seconds // 60 % 60:02d}:{seconds % 60:02d}"
+            elif kind == "strs":
+                count, position = read_varint(data, position)
+                value = []
+                for _ in range(count):
+                    item, position = read_text(data, position)
+                    value.append(item)
+            else:  # frames
+                count, position = read_varint(data, position)
+                value = []
+                for _ in range(count):
+                    length, position = read_varint(data, position)
+                    value.append(self.decode(data[position:position + length]))
+                    position += length
+            message_data[key] = value
+        return message_data
+
+# 类型和字段的编号查找表
+BINARY_TYPE_CODES = {message_type: index + 1 for index, message_type in enumerate(BINARY_TYPES)}
+BINARY_FIELD_CODES = {key: (index, kind) for index, (key, kind) in enumerate(BINARY_FIELDS)}
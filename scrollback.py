@@ -0,0 +1,228 @@
+import os
+import re
+from collections import defaultdict
+from urllib.parse import quote
+from protocol import dumps, loads
+
+# 每个段文件保存的记录条数，写满后保存该段的索引并开始新段
+SCROLLBACK_SEGMENT_LINES = 1000
+
+# 每个频道最多保留的段数，超出时删除最早的段
+SCROLLBACK_MAX_SEGMENTS = 50
+
+# 翻看记录时每页的条数
+SCROLLBACK_PAGE_SIZE = 20
+
+# 查找时最多返回的条数
+SCROLLBACK_SEARCH_LIMIT = 50
+
+# 建立索引的词：连续的英文字母和数字为一个词，其他文字（中文等）每个字为一个词
+WORD_PATTERN = re.compile(r"[a-z0-9_]+|[^\W_a-z0-9]")
+
+def index_words(text):
+    """切分出文本中建立索引的词"""
+    return set(WORD_PATTERN.findall(text.lower()))
+
+def record_text(record):
+    """记录中参与查找的文本：发送者和消息内容"""
+    return f"{record.get('username', '')} {record.get('message', '')}"
+
+def record_key(record):
+    """判断回放的历史消息是否已记录的键：时间、发送者和消息内容都由服务器在发出时确定，各节点相同"""
+    return record.get('time'), record.get('username'), record.get('message')
+
+class ChannelScrollback:
+    """单个频道的本地聊天记录：按段追加写入磁盘，每段带倒排索引
+
+    当前段的索引保存在内存中，写满的段把索引写入同名的 .idx 文件，之后只在查找时读取，
+    因此内存占用只与段大小有关，不随记录条数增长。段数超过上限时删除最早的段。
+    """
+
+    def __init__(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.segments = sorted(int(name[:-4]) for name in os.listdir(directory)
+                               if name.endswith('.log') and name[:-4].isdigit()) or [1]
+        # 最近记录的键，用于跳过重复回放的历史消息；消息序号由各节点分别编号，不能用于判断
+        self.recent = {}  # {记录的键: None}，按记录先后排列
+        if len(self.segments) > 1:
+            for _, record in self.read_segment(self.segments[-2]):
+                self.remember(record)
+        self.open_segment(self.segments[-1])
+
+    def segment_path(self, number, suffix):
+        """段文件的路径"""
+        return os.path.join(self.directory, f"{number:08d}{suffix}")
+
+    def open_segment(self, number):
+        """打开段文件用于追加，已有内容时重建其索引；末尾不完整的记录（写入时中断）被截掉"""
+        self.index = defaultdict(list)  # {词: [记录在段文件中的位置]}
+        self.line_count = 0
+        path = self.segment_path(number, '.log')
+        offset = 0
+        if os.path.exists(path):
+            with open(path, 'rb') as segment:
+                for line in segment:
+                    try:
+                        record = loads(line)
+                    except ValueError:
+                        break
+                    self.add_to_index(record, offset)
+                    offset += len(line)
+                    self.line_count += 1
+                    self.remember(record)
+        self.file = open(path, 'ab')
+        self.file.truncate(offset)
+        self.offset = offset
+
+    def add_to_index(self, record, offset):
+        """把记录中的词加入当前段的索引"""
+        for word in index_words(record_text(record)):
+            self.index[word].append(offset)
+
+    def append(self, record):
+        """追加一条记录"""
+        line = (dumps(record) + "\n").encode('utf-8')
+        self.file.write(line)
+        self.add_to_index(record, self.offset)
+        self.offset += len(line)
+        self.line_count += 1
+        if self.line_count >= SCROLLBACK_SEGMENT_LINES:
+            self.seal()
+
+    def remember(self, record):
+        """登记最近的记录，最多保留一段的条数"""
+        key = record_key(record)
+        self.recent.pop(key, None)
+        self.recent[key] = None
+        if len(self.recent) > SCROLLBACK_SEGMENT_LINES:
+            del self.recent[next(iter(self.recent))]
+
+    def record(self, record, replayed=False):
+        """记录一条聊天消息；回放的历史消息与最近的记录相同时已经记录过，跳过"""
+        if replayed and record_key(record) in self.recent:
+            return
+        self.remember(record)
+        self.append(record)
+
+    def seal(self):
+        """当前段已写满：保存其索引并开始新段，超出段数上限时删除最早的段"""
+        self.file.close()
+        with open(self.segment_path(self.segments[-1], '.idx'), 'w', encoding='utf-8') as index_file:
+            index_file.write(dumps(self.index))
+        self.segments.append(self.segments[-1] + 1)
+        while len(self.segments) > SCROLLBACK_MAX_SEGMENTS:
+            oldest = self.segments.pop(0)
+            for suffix in ('.log', '.idx'):
+                try:
+                    os.remove(self.segment_path(oldest, suffix))
+                except FileNotFoundError:
+                    pass
+        self.open_segment(self.segments[-1])
+
+    def segment_index(self, number):
+        """返回段的索引：当前段在内存中，已写满的段从索引文件读取，索引文件缺失时重新建立"""
+        if number == self.segments[-1]:
+            return self.index
+        try:
+            with open(self.segment_path(number, '.idx'), 'rb') as index_file:
+                return loads(index_file.read())
+        except (FileNotFoundError, ValueError):
+            index = defaultdict(list)
+            for offset, record in self.read_segment(number):
+                for word in index_words(record_text(record)):
+                    index[word].append(offset)
+            return index
+
+    def read_segment(self, number):
+        """依次返回段中的 (位置, 记录)"""
+        if number == self.segments[-1]:
+            self.file.flush()
+        offset = 0
+        try:
+            with open(self.segment_path(number, '.log'), 'rb') as segment:
+                for line in segment:
+                    try:
+                        yield offset, loads(line)
+                    except ValueError:
+                        return
+                    offset += len(line)
+        except FileNotFoundError:
+            return
+
+    def search(self, query, limit=SCROLLBACK_SEARCH_LIMIT):
+        """查找包含 query 中所有词的记录，最近的在前
+
+        先用索引求出包含所有词的记录，再确认记录包含 query 中每个以空格分隔的片段，
+        使中文等按字索引的文字也按连续的片段匹配。
+        """
+        words = index_words(query)
+        if not words:
+            return []
+        terms = query.lower().split()
+        self.file.flush()
+
+        results = []
+        for number in reversed(self.segments):
+            index = self.segment_index(number)
+            postings = [index.get(word) for word in words]
+            if not all(postings):
+                continue
+            offsets = set(postings[0]).intersection(*postings[1:])
+            with open(self.segment_path(number, '.log'), 'rb') as segment:
+                for offset in sorted(offsets, reverse=True):
+                    segment.seek(offset)
+                    record = loads(segment.readline())
+                    text = record_text(record).lower()
+                    if all(term in text for term in terms):
+                        results.append(record)
+                        if len(results) >= limit:
+                            return results
+        return results
+
+    def count(self):
+        """记录总条数"""
+        return (len(self.segments) - 1) * SCROLLBACK_SEGMENT_LINES + self.line_count
+
+    def page(self, number, size=SCROLLBACK_PAGE_SIZE):
+        """返回第 number 页的记录（第 1 页为最近的记录），页内按时间先后排列"""
+        skip = (number - 1) * size
+        collected = []
+        for segment in reversed(self.segments):
+            records = [record for _, record in self.read_segment(segment)]
+            if skip >= len(records):
+                skip -= len(records)
+                continue
+            end = len(records) - skip
+            skip = 0
+            collected = records[max(0, end - (size - len(collected))):end] + collected
+            if len(collected) >= size:
+                break
+        return collected
+
+    def close(self):
+        """写入缓冲的记录并关闭当前段文件"""
+        self.file.close()
+
+class ScrollbackStore:
+    """按频道管理本地聊天记录，频道首次使用时打开"""
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.channels = {}  # {频道ID: ChannelScrollback}
+
+    def channel(self, channel_id):
+        """返回频道的聊天记录"""
+        scrollback = self.channels.get(channel_id)
+        if scrollback is None:
+            # 频道ID编码为安全的目录名（包括 . 和 ..）
+            name = quote(channel_id, safe='').replace('.', '%2E') or '%00'
+            scrollback = ChannelScrollback(os.path.join(self.directory, name))
+            self.channels[channel_id] = scrollback
+        return scrollback
+
+    def close(self):
+        """关闭所有频道的聊天记录"""
+        for scrollback in self.channels.values():
+            scrollback.close()
+        self.channels.clear()
@@ -1,101 +1,917 @@
 import asyncio
 import websockets
-import json
-from datetime import datetime
-from collections import defaultdict
+from collections import defaultdict, deque
+from itertools import islice
 import hashlib
+import multiprocessing
+import os
+import random
+import secrets
+import tempfile
+import time
+from protocol import BINARY_SUBPROTOCOL, BinaryCodec, ProtocolError, current_time, decode_request, dumps, static_frame
+from bus import BusBroker, BrokerBackplane, LocalBackplane
+from compression import deflate_extensions, share_frame
+from metrics import Counter, Gauge, Histogram, serve_metrics
+from profiler import install_profile_signal
+from timers import TimerWheel
 
 ADMIN_PASSWORD_HASH = ""
 
+# 监听地址和端口
+SERVER_HOST = "0.0.0.0"
+SERVER_PORT = 8765
+
+# 工作进程数量，大于 1 时以多进程模式运行，各进程通过 SO_REUSEPORT 共享端口
+WORKER_COUNT = 1
+
+# 多进程模式下进程间消息总线使用的 Unix 域套接字路径
+BUS_SOCKET_PATH = os.path.join(tempfile.gettempdir(), "websocket-chat-bus.sock")
+
+# 多节点集群的消息总线中转端地址（格式: ip:端口，运行 bus.py 启动），None 表示不加入集群
+BACKPLANE_ADDRESS = None
+
+# 运行指标 HTTP 接口（GET /metrics）的监听地址和端口，None 表示不启用
+# 多进程模式下第 N 个工作进程使用 METRICS_PORT + N
+METRICS_HOST = "127.0.0.1"
+METRICS_PORT = None
+
+# 慢请求跟踪阈值（秒）：单个请求的处理耗时超过该值时输出日志，None 表示不跟踪
+SLOW_HANDLER_THRESHOLD = None
+
 # 允许的频道列表
 ALLOWED_CHANNELS = ["public","1","2","3"]
 
-# 数据结构：{频道ID: {用户名: websocket连接}}
+# 管理员命令中表示"任意频道"的频道ID，按用户名在全服索引中查找所在频道
+ANY_CHANNEL = "*"
+
+# ::lists 每页显示的用户数
+LISTS_PAGE_SIZE = 100
+
+# 回复中引用客户端输入（频道名、请求类型等）时最多保留的字符数
+ECHO_TEXT_LIMIT = 64
+
+# 数据结构：{频道ID: {用户名: Session}}
 channels = defaultdict(dict)
 
-# 反向映射：{websocket连接: (用户名, 频道, 是否管理员)}
-connection_map = {}
+# 所有连接的会话：{websocket连接: Session}
+sessions = {}
 
-async def broadcast(channel_id, message_data):
-    """向指定频道的所有在线用户广播消息"""
-    if channel_id not in channels:
-        return
+# 单个连接发送队列的高水位（队列中消息的总长度），超过后不再接收新消息
+OUTBOX_HIGH_WATERMARK = 1024 * 1024
+# 发送队列回落到低水位以下后恢复接收新消息
+OUTBOX_LOW_WATERMARK = 256 * 1024
+# 慢消费者处理策略："close" 持续超限后断开连接，"drop" 仅丢弃超限期间的消息
+SLOW_CONSUMER_POLICY = "close"
+# 发送队列持续超过高水位多少秒后断开连接
+SLOW_CONSUMER_TIMEOUT = 10
+
+# 本进程的连接总数上限，None 表示不限制
+MAX_CONNECTIONS = 10000
+# 同一 IP 的连接数上限，None 表示不限制（同一 NAT 后的用户共用 IP，按部署环境设置）
+MAX_CONNECTIONS_PER_IP = None
+# 接受新连接的速率：(每秒接受的连接数, 最多可连续接受的连接数)，None 表示不限制
+ACCEPT_RATE_LIMIT = (200, 400)
+# 已完成握手但首个请求尚未处理完的连接数上限，None 表示不限制
+# 重连风暴中客户端接入后立即登录或恢复会话，登录要占用用户名、回放历史，是主要开销
+MAX_PENDING_LOGINS = 500
+# 连接接入多少秒后仍未发出请求即不再计入上述上限（终端客户端在用户发送第一条消息时才登录，停留在提示符的连接不应占用名额）
+PENDING_LOGIN_WINDOW = 5
+# WebSocket 握手超时（秒）
+HANDSHAKE_TIMEOUT = 10
+# 拒绝连接时建议客户端等待的秒数，实际在 1~2 倍之间随机，避免被拒绝的客户端同时重试
+ADMISSION_RETRY_AFTER = 5
+
+# 各 IP 的连接数：{IP: 连接数}
+connections_per_ip = defaultdict(int)
+# 已完成握手、首个请求尚未处理完的连接数
+pending_logins = 0
+
+# 是否启用 permessage-deflate 压缩
+COMPRESSION_ENABLED = True
+# 压缩窗口大小（2 的幂，8~15），越大压缩率越高，每个连接占用的内存也越多
+COMPRESSION_WINDOW_BITS = 12
+# zlib 内存级别（1~9），越大压缩越快、压缩率越高，每个连接占用的内存也越多
+COMPRESSION_MEMORY_LEVEL = 5
+# 小于该长度（字节）的消息不压缩，短消息压缩收益很小却要为每个接收者消耗 CPU
+COMPRESSION_MIN_SIZE = 256
+# 广播消息只压缩一次供所有接收者共用；需要不保留压缩上下文，单条消息的压缩率略低
+COMPRESSION_SHARED = True
+# 广播消息不压缩的频道，适用于成员很多、消息很短的大频道
+COMPRESSION_DISABLED_CHANNELS = []
+
+# 二进制编码器及连接建立时发给二进制连接的频道表，频道表内的频道以编号传输
+binary_codec = BinaryCodec(ALLOWED_CHANNELS)
+channel_table_frame = binary_codec.encode({"type": "channels", "channels": ALLOWED_CHANNELS})
+
+# 运行指标
+connections_accepted = Counter("chat_connections_accepted_total", "已接受的连接数")
+connections_closed = Counter("chat_connections_closed_total", "已关闭的连接数")
+connections_rejected = Counter("chat_connections_rejected_total", "准入控制拒绝的连接数，按原因分组", "reason")
+connections_reaped = Counter("chat_connections_reaped_total", "因超时被清理的连接数，按原因分组", "reason")
+actions_handled = Counter("chat_actions_total", "按类型统计已处理的客户端请求数", "action")
+rate_limited = Counter("chat_rate_limited_total", "超过发送频率限制的消息数，按处理方式分组", "outcome")
+broadcast_duration = Histogram("chat_broadcast_fanout_seconds", "单次广播投递到本节点所有成员发送队列的耗时")
+send_duration = Histogram("chat_send_seconds", "单条消息写入连接的耗时")
+Gauge("chat_channel_members", "本节点各频道的在线用户数",
+      lambda: {channel_id: len(members) for channel_id, members in channels.items()}, "channel")
+Gauge("chat_outbox_queued_bytes", "所有连接发送队列中待发送消息的总长度",
+      lambda: sum(session.outbox.queued_bytes for session in sessions.values()))
+Gauge("chat_outbox_congested", "发送队列超过高水位的连接数",
+      lambda: sum(1 for session in sessions.values() if session.outbox.congested_since is not None))
+
+# 集群背板：广播、在线用户和管理员命令都经由它同步到其他节点
+backplane = LocalBackplane()
+
+# 后台任务的引用，避免任务在完成前被回收
+background_tasks = set()
+
+def trace_slow_handler(action, channel_id, started):
+    """请求处理耗时超过阈值时，输出请求类型、频道和扇出规模"""
+    elapsed = time.monotonic() - started
+    if elapsed >= SLOW_HANDLER_THRESHOLD:
+        fanout = len(channels.get(channel_id, ())) if channel_id else 0
+        print(f"慢请求: {action} 耗时 {elapsed * 1000:.1f} ms，频道 {channel_id}，扇出 {fanout} 个连接")
+
+def run_in_background(coro):
+    """在后台运行协程，不阻塞当前连接的处理"""
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
+# 每个频道保留的历史消息条数上限
+HISTORY_MAX_FRAMES = 200
+# 每个频道历史消息的总长度上限
+HISTORY_MAX_BYTES = 256 * 1024
+# 客户端单次可请求的历史消息条数上限
+HISTORY_MAX_REPLAY = 200
+
+# 成员变动（加入/离开频道）的合并窗口（秒），窗口内的变动合并为一条消息广播
+PRESENCE_BATCH_WINDOW = 0.5
+# 本节点频道人数超过此值时不再广播成员变动，用户可按需查询
+PRESENCE_QUIET_THRESHOLD = 500
+# 每个频道保留的最近成员变动条数，供按需查询用户名
+PRESENCE_RECENT_LIMIT = 200
+
+# 批量断开连接时等待客户端完成关闭握手的总时限（秒），超时后强制断开
+EVICT_GRACE_PERIOD = 5
+# 批量断开期间向管理员报告进度的间隔（秒）
+EVICT_PROGRESS_INTERVAL = 1
+
+# 断线后保留会话的宽限时间（秒），期间客户端可凭恢复令牌重新接入
+RESUME_GRACE_PERIOD = 30
+
+# 连接建立后必须在多少秒内完成登录或加入频道，None 表示不限制
+# 终端客户端在用户发送第一条消息时才登录，停留在提示符的连接也是正常使用，只在客户端连接后立即登录时设置
+LOGIN_TIMEOUT = None
+# 已登录用户多少秒没有发送任何请求后断开，None 表示不限制（只接收消息的用户也是正常使用）
+IDLE_TIMEOUT = None
+# 连接多少秒没有收到任何数据后发送心跳 ping，None 表示不发送心跳
+HEARTBEAT_INTERVAL = 20
+# 心跳 ping 发出后多少秒内没有收到 pong 视为半开连接，直接断开
+HEARTBEAT_TIMEOUT = 20
+# 超时检查定时轮的刻度（秒）和槽数，槽数乘刻度为一圈的时长
+TIMER_WHEEL_TICK = 1
+TIMER_WHEEL_SLOTS = 64
+
+# 断线保留的会话：{恢复令牌: (用户名, 频道, 是否管理员, 历史序号编号, 过期定时器)}
+suspended_sessions = {}
+
+# 宽限期内保留的用户名：{(频道, 用户名): 恢复令牌}
+reserved_usernames = {}
+
+# 断线期间被管理员踢出或断开的会话，宽限期内凭令牌恢复时补发通知：{恢复令牌: (频道, 处理方式, 通知)}
+revoked_sessions = {}
+
+async def claim_username(channel_id, username, session):
+    """检查用户名在频道中是否可用，并在集群中占用它"""
+    # 本节点内的检查：其他连接正在使用或宽限期内保留
+    existing_session = channels[channel_id].get(username)
+    if existing_session is not None and existing_session is not session:
+        return False
+    if (channel_id, username) in reserved_usernames:
+        return False
     
-    message_data["time"] = datetime.now().strftime("%H:%M:%S")
-    message_data["channel"] = channel_id
-    message_json = json.dumps(message_data)
+    # 集群内的检查：其他节点是否已占用
+    if not await backplane.claim(channel_id, username):
+        return False
     
-    for websocket in list(channels[channel_id].values()):  # 使用列表避免迭代中修改
+    # 等待背板回复期间本节点的其他连接可能已占用该用户名
+    existing_session = channels[channel_id].get(username)
+    return existing_session is None or existing_session is session
+
+def join_channel(channel_id, username, session):
+    """将已占用用户名的用户加入本节点的频道成员表"""
+    channels[channel_id][username] = session
+
+def leave_channel(channel_id, username, release=True):
+    """将用户移出本节点的频道成员表并释放用户名，返回其会话（不在频道中时返回 None）"""
+    session = channels[channel_id].pop(username, None)
+    if session is not None and release:
+        backplane.release(channel_id, username)
+    return session
+
+def in_channel(session):
+    """会话是否仍是其频道中该用户名对应的连接（被踢出、清退或被恢复的会话接管后不再是）"""
+    return session.channel is not None and channels[session.channel].get(session.username) is session
+
+def remove_connection(websocket):
+    """从频道中移除已关闭的连接"""
+    session = sessions.get(websocket)
+    if session is not None and in_channel(session):
+        leave_channel(session.channel, session.username)
+        session.channel = None
+
+class ChannelHistory:
+    """频道历史消息的环形缓冲区，保存带递增序号的已序列化消息"""
+
+    def __init__(self):
+        self.frames = deque()  # (序号, 已序列化的消息)
+        self.total_bytes = 0
+        self.last_seq = 0
+
+    def append(self, message_json):
+        """为消息分配序号并记入历史，返回带序号的消息"""
+        self.last_seq += 1
+        # 直接拼接序号字段，避免重新序列化
+        message_json = f'{{"seq": {self.last_seq}, {message_json[1:]}'
+        self.frames.append((self.last_seq, message_json))
+        self.total_bytes += len(message_json)
+        
+        # 超出条数或长度上限时丢弃最旧的消息
+        while len(self.frames) > HISTORY_MAX_FRAMES or self.total_bytes > HISTORY_MAX_BYTES:
+            _, dropped = self.frames.popleft()
+            self.total_bytes -= len(dropped)
+        return message_json
+
+    def last(self, count):
+        """返回最近 count 条消息"""
+        count = min(count, len(self.frames))
+        return [frame for _, frame in islice(self.frames, len(self.frames) - count, None)]
+
+    def since(self, seq):
+        """返回序号大于 seq 的消息，以及是否有消息已被丢弃"""
+        if not self.frames:
+            return [], seq < self.last_seq
+        first_seq = self.frames[0][0]
+        start = max(seq + 1 - first_seq, 0)
+        return [frame for _, frame in islice(self.frames, start, None)], seq + 1 < first_seq
+
+# 频道历史：{频道ID: ChannelHistory}
+histories = defaultdict(ChannelHistory)
+
+# 本进程历史消息序号的编号标识：各节点和工作进程各自为收到的广播编号，进程重启后重新编号，
+# 客户端断线前收到的序号只在同一编号下有效
+history_epoch = secrets.token_hex(4)
+
+class ChannelPresence:
+    """频道成员变动的合并缓冲区，以及最近变动的用户名记录"""
+
+    def __init__(self):
+        self.changes = {}  # 合并窗口内尚未广播的变动：{用户名: "join" 或 "leave"}
+        self.timer = None  # 合并窗口结束时的广播定时器
+        self.recent = deque(maxlen=PRESENCE_RECENT_LIMIT)  # 最近的变动：(事件, 用户名)
+
+    def record(self, username, event):
+        """记录一次变动，同一用户在窗口内相反的变动（如断线重连）相互抵消"""
+        if self.changes.get(username, event) != event:
+            del self.changes[username]
+        else:
+            self.changes[username] = event
+
+# 频道成员变动：{频道ID: ChannelPresence}
+presences = defaultdict(ChannelPresence)
+
+# 聊天消息的发送频率限制：(每秒补充的消息数, 最多可连续发送的消息数)，None 表示不限制
+RATE_LIMIT_CONNECTION = (5, 10)  # 每个连接
+RATE_LIMIT_USER = (5, 10)  # 每个用户名，断线重连不会重置
+RATE_LIMIT_CHANNEL = (200, 400)  # 每个频道，所有成员合计
+# 超过频率限制时的处理策略："error" 丢弃并回复错误，"drop" 直接丢弃，"throttle" 延迟处理
+RATE_LIMIT_POLICY = "error"
+# "throttle" 策略下最多延迟的秒数，需要等待更久的消息按 "error" 处理
+RATE_LIMIT_MAX_DELAY = 2
+# 用户令牌桶数量超过该值时清理已回满的桶
+RATE_BUCKET_PRUNE_SIZE = 10000
+
+class TokenBucket:
+    """令牌桶：按固定速率补充令牌，每条消息消耗一个，记账只更新两个数值"""
+
+    __slots__ = ("rate", "burst", "tokens", "updated")
+
+    def __init__(self, limit):
+        self.rate, self.burst = limit
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+
+    def wait_time(self, now):
+        """补充令牌，返回取得一个令牌还需等待的秒数（0 表示可以立即发送）"""
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def is_full(self, now):
+        """令牌是否已回满，回满的桶与新建的桶等价"""
+        return self.tokens + (now - self.updated) * self.rate >= self.burst
+
+# 令牌桶：{用户名: TokenBucket}，{频道ID: TokenBucket}
+user_buckets = {}
+channel_buckets = {}
+# 下次清理用户令牌桶时的数量，每次清理后按剩余数量加倍，清理开销均摊到每次新建
+user_buckets_prune_at = RATE_BUCKET_PRUNE_SIZE
+
+def user_bucket(username, now):
+    """取得用户的令牌桶，数量过多时先清理已回满的桶"""
+    global user_buckets_prune_at
+    bucket = user_buckets.get(username)
+    if bucket is None:
+        if len(user_buckets) >= user_buckets_prune_at:
+            for name in [name for name, old in user_buckets.items() if old.is_full(now)]:
+                del user_buckets[name]
+            user_buckets_prune_at = max(RATE_BUCKET_PRUNE_SIZE, len(user_buckets) * 2)
+        bucket = user_buckets[username] = TokenBucket(RATE_LIMIT_USER)
+    return bucket
+
+def channel_bucket(channel_id):
+    """取得频道的令牌桶"""
+    bucket = channel_buckets.get(channel_id)
+    if bucket is None:
+        bucket = channel_buckets[channel_id] = TokenBucket(RATE_LIMIT_CHANNEL)
+    return bucket
+
+# 接受新连接的令牌桶
+accept_bucket = TokenBucket(ACCEPT_RATE_LIMIT) if ACCEPT_RATE_LIMIT is not None else None
+
+def rate_limit_wait(session, now):
+    """检查连接、用户和频道的令牌桶，返回发送下一条消息还需等待的秒数"""
+    wait = 0
+    if session.message_bucket is not None:
+        wait = session.message_bucket.wait_time(now)
+    if RATE_LIMIT_USER is not None:
+        wait = max(wait, user_bucket(session.username, now).wait_time(now))
+    if RATE_LIMIT_CHANNEL is not None:
+        wait = max(wait, channel_bucket(session.channel).wait_time(now))
+    return wait
+
+def consume_rate_limit(session):
+    """从连接、用户和频道的令牌桶中各取一个令牌"""
+    if session.message_bucket is not None:
+        session.message_bucket.tokens -= 1
+    if RATE_LIMIT_USER is not None:
+        user_buckets[session.username].tokens -= 1
+    if RATE_LIMIT_CHANNEL is not None:
+        channel_buckets[session.channel].tokens -= 1
+
+class Outbox:
+    """单个连接的有界发送队列，由独立的写任务按顺序发送"""
+
+    __slots__ = ("websocket", "queue", "queued_bytes", "dropped", "congested_since", "close_args",
+                 "binary", "wakeup", "task")
+
+    def __init__(self, websocket):
+        self.websocket = websocket
+        self.queue = deque()
+        self.queued_bytes = 0
+        self.dropped = 0
+        self.congested_since = None  # 超过高水位的起始时间，None 表示未超限
+        self.close_args = None  # 发送完队列后需要关闭连接时的 (code, reason)
+        self.binary = websocket.subprotocol == BINARY_SUBPROTOCOL  # 是否使用二进制编码
+        self.wakeup = asyncio.Event()
+        self.task = asyncio.create_task(self.writer())
+
+    def put(self, message_json):
+        """将消息（JSON 文本或二进制帧）放入发送队列，队列超限时丢弃并返回 False"""
+        if self.close_args is not None:
+            return False
+        
+        if self.congested_since is not None or self.queued_bytes >= OUTBOX_HIGH_WATERMARK:
+            now = time.monotonic()
+            if self.congested_since is None:
+                self.congested_since = now
+            self.dropped += 1
+            
+            # 持续超限的慢消费者直接断开，不再等待队列发送完毕
+            if SLOW_CONSUMER_POLICY == "close" and now - self.congested_since >= SLOW_CONSUMER_TIMEOUT:
+                self.evict()
+            return False
+        
+        self.queue.append(message_json)
+        self.queued_bytes += len(message_json)
+        self.wakeup.set()
+        return True
+
+    def close(self, code=1000, reason=""):
+        """发送完队列中已有的消息后关闭连接"""
+        if self.close_args is None:
+            self.close_args = (code, reason)
+            self.wakeup.set()
+
+    def evict(self):
+        """丢弃队列并立即断开慢消费者，不等待卡住的发送完成"""
+        print(f"连接发送队列持续超限，断开慢消费者（已丢弃 {self.dropped} 条消息）")
+        self.queue.clear()
+        self.queued_bytes = 0
+        self.close_args = (1008, "slow consumer")
+        self.task.cancel()
+        self.task = asyncio.create_task(self.websocket.close(*self.close_args))
+
+    async def writer(self):
+        """写任务：依次发送队列中的消息"""
         try:
-            await websocket.send(message_json)
+            while True:
+                if not self.queue:
+                    if self.close_args is not None:
+                        await self.websocket.close(*self.close_args)
+                        return
+                    self.wakeup.clear()
+                    await self.wakeup.wait()
+                    continue
+                
+                message_json = self.queue.popleft()
+                self.queued_bytes -= len(message_json)
+                if self.congested_since is not None and self.queued_bytes <= OUTBOX_LOW_WATERMARK:
+                    self.congested_since = None
+                
+                send_start = time.perf_counter()
+                # 广播消息可能已编码为 bytes，按连接的编码方式决定以文本帧还是二进制帧发送
+                await self.websocket.send(message_json, text=not self.binary)
+                send_duration.observe(time.perf_counter() - send_start)
         except websockets.exceptions.ConnectionClosed:
             # 移除已关闭的连接
-            if websocket in connection_map:
-                username, channel, is_admin = connection_map[websocket]
-                if username in channels[channel]:
-                    del channels[channel][username]
-                del connection_map[websocket]
+            remove_connection(self.websocket)
+
+def send_frame(websocket, message_json):
+    """将已序列化的消息放入连接的发送队列，不等待实际发送；二进制连接转为二进制编码"""
+    session = sessions.get(websocket)
+    if session is None:
+        return False
+    outbox = session.outbox
+    if outbox.binary:
+        return outbox.put(binary_codec.encode_json(message_json))
+    return outbox.put(message_json)
+
+def select_subprotocol(protocol, subprotocols):
+    """客户端支持时使用二进制编码，否则不选择子协议，使用 JSON 文本"""
+    if BINARY_SUBPROTOCOL in subprotocols:
+        return BINARY_SUBPROTOCOL
+    return None
+
+def send_message(websocket, message_data):
+    """序列化消息并放入连接的发送队列"""
+    return send_frame(websocket, dumps(message_data))
+
+def send_static(websocket, message_type, channel, message):
+    """发送只含类型、频道和文本的响应，编码结果按内容缓存复用
+
+    只用于取值有限的响应：文本固定，频道为允许的频道或服务器选定的值。
+    引用客户端输入的响应用 send_reply 发送，否则客户端可以用任意内容占满缓存。
+    """
+    return send_frame(websocket, static_frame(message_type, channel, message))
+
+def send_reply(websocket, message_type, channel, message):
+    """发送引用客户端输入的响应：直接编码不缓存，频道名截断到 ECHO_TEXT_LIMIT"""
+    return send_message(websocket, {"type": message_type, "channel": echo_text(channel), "message": message})
+
+def send_result(websocket, data, message_data):
+    """发送登录或切换频道请求的结果，请求带有 request_id 时原样带回，客户端据此把结果对应到请求"""
+    if data.get('request_id') is not None:
+        message_data["request_id"] = data['request_id']
+    return send_message(websocket, message_data)
+
+def echo_text(value):
+    """截断要在回复中引用的客户端输入"""
+    value = str(value)
+    if len(value) > ECHO_TEXT_LIMIT:
+        return value[:ECHO_TEXT_LIMIT] + "…"
+    return value
+
+def close_connection(websocket, code=1000, reason=""):
+    """发送完已排队的消息后关闭连接"""
+    session = sessions.get(websocket)
+    if session is None:
+        return
+    session.outbox.close(code, reason)
+
+async def broadcast(channel_id, message_data):
+    """向指定频道的所有在线用户广播消息"""
+    message_data["time"] = current_time()
+    message_data["channel"] = channel_id
+    # 只序列化一次，本节点和其他节点共用同一份消息
+    message_json = dumps(message_data)
+    
+    backplane.publish({"op": "broadcast", "channel": channel_id, "frame": message_json})
+    deliver_broadcast(channel_id, message_json)
+
+def deliver_broadcast(channel_id, message_json):
+    """将已序列化的广播消息记入频道历史，并投递给本节点中的频道成员"""
+    message_json = histories[channel_id].append(message_json)
+    
+    # 放入每个接收者的发送队列，慢连接不会阻塞其他用户
+    fanout_start = time.perf_counter()
+    # 编码为 bytes 后所有接收者共用同一个对象，登记后压缩扩展可以复用压缩结果
+    text_frame = message_json.encode('utf-8')
+    compress = channel_id not in COMPRESSION_DISABLED_CHANNELS
+    if COMPRESSION_ENABLED:
+        share_frame(text_frame, compress)
+    binary_frame = None  # 二进制编码在遇到第一个二进制连接时才生成，所有二进制连接共用
+    for session in list(channels[channel_id].values()):  # 使用列表避免迭代中修改
+        outbox = session.outbox
+        if outbox.binary:
+            if binary_frame is None:
+                binary_frame = binary_codec.encode_json(message_json)
+                if COMPRESSION_ENABLED:
+                    share_frame(binary_frame, compress)
+            outbox.put(binary_frame)
+        else:
+            outbox.put(text_frame)
+    broadcast_duration.observe(time.perf_counter() - fanout_start)
+
+def announce_presence(channel_id, username, event):
+    """记录用户加入（join）或离开（leave）频道，合并窗口结束后统一广播"""
+    presence = presences[channel_id]
+    presence.record(username, event)
+    if presence.timer is None:
+        presence.timer = asyncio.get_running_loop().call_later(PRESENCE_BATCH_WINDOW, flush_presence, channel_id)
+
+def flush_presence(channel_id):
+    """合并窗口结束，将窗口内的成员变动发给所有节点"""
+    presence = presences[channel_id]
+    presence.timer = None
+    changes, presence.changes = presence.changes, {}
+    joined = [username for username, event in changes.items() if event == "join"]
+    left = [username for username, event in changes.items() if event == "leave"]
+    if not joined and not left:
+        return
+    
+    backplane.publish({"op": "presence", "channel": channel_id, "joined": joined, "left": left})
+    deliver_presence(channel_id, joined, left)
+
+def deliver_presence(channel_id, joined, left):
+    """记录成员变动的用户名，并向本节点的频道成员广播一条合并后的变动消息"""
+    presence = presences[channel_id]
+    presence.recent.extend(("join", username) for username in joined)
+    presence.recent.extend(("leave", username) for username in left)
+    
+    # 大频道中逐个广播成员变动的代价太高，直接省略
+    if len(channels[channel_id]) > PRESENCE_QUIET_THRESHOLD:
+        return
+    
+    if len(joined) + len(left) == 1:
+        text = f"{joined[0]} 加入了频道" if joined else f"{left[0]} 离开了频道"
+    else:
+        counts = ([f"+{len(joined)} 人加入"] if joined else []) + ([f"-{len(left)} 人离开"] if left else [])
+        text = f"{'，'.join(counts)}（::who 查看名单）"
+    deliver_broadcast(channel_id, dumps({
+        "type": "presence",
+        "joined": len(joined),
+        "left": len(left),
+        "message": text,
+        "time": current_time(),
+        "channel": channel_id
+    }))
+
+def send_presence(websocket, channel_id):
+    """向用户发送频道最近成员变动的用户名"""
+    presence = presences.get(channel_id)
+    if presence is None or not presence.recent:
+        send_static(websocket, "system", channel_id, f"频道 '{channel_id}' 暂无成员变动记录")
+        return
+    
+    send_message(websocket, {
+        "type": "user_list",
+        "channel": channel_id,
+        "message": f"频道 '{channel_id}' 最近的成员变动 ({len(presence.recent)}):",
+        "users": "    ".join(f"{'+' if event == 'join' else '-'}{username}" for event, username in presence.recent)
+    })
+
+def send_history(websocket, channel_id, history_request, epoch=None):
+    """按客户端请求（最近N条或指定序号之后）一次性发送频道历史消息
+
+    epoch 为客户端序号所属的编号，与本进程不同时序号无法对应，不补发消息，只告知客户端历史不完整。
+    """
+    if not isinstance(history_request, dict) or channel_id not in histories:
+        return
+    
+    history = histories[channel_id]
+    truncated = False
+    since = history_request.get('since')
+    last = history_request.get('last')
+    if isinstance(since, int) and epoch not in (None, history_epoch):
+        frames, truncated = [], True
+    elif isinstance(since, int):
+        frames, truncated = history.since(since)
+        if len(frames) > HISTORY_MAX_REPLAY:
+            frames = frames[-HISTORY_MAX_REPLAY:]
+            truncated = True
+    elif isinstance(last, int) and last > 0:
+        frames = history.last(min(last, HISTORY_MAX_REPLAY))
+    else:
+        return
+    
+    # 历史消息已序列化，直接拼接成一条批量消息发送
+    header = dumps({
+        "type": "history",
+        "channel": channel_id,
+        "last_seq": history.last_seq,
+        "truncated": truncated
+    })
+    send_frame(websocket, f'{header[:-1]}, "frames": [{", ".join(frames)}]}}')
+
+def suspend_session(resume_token, username, channel, is_admin):
+    """保留断线用户的会话，宽限期结束前不广播断开消息"""
+    timer = asyncio.get_running_loop().call_later(RESUME_GRACE_PERIOD, expire_session, resume_token)
+    suspended_sessions[resume_token] = (username, channel, is_admin, history_epoch, timer)
+    reserved_usernames[(channel, username)] = resume_token
+    
+    # 通知其他节点，客户端重连到任意节点都能恢复会话
+    backplane.publish({"op": "suspend", "token": resume_token, "username": username,
+                       "channel": channel, "is_admin": is_admin, "epoch": history_epoch})
+
+def drop_session(resume_token):
+    """移除待恢复的会话及其用户名保留，返回会话（不存在时返回 None）"""
+    session = suspended_sessions.pop(resume_token, None)
+    if session is None:
+        return None
+    
+    username, channel, is_admin, epoch, timer = session
+    if timer is not None:
+        timer.cancel()
+    reserved_usernames.pop((channel, username), None)
+    return session
+
+def revoke_session(channel_id, username, mode, notice):
+    """撤销频道中用户等待恢复的会话（管理员踢出或断开断线中的用户），返回是否存在这样的会话
+
+    各节点都保存了该会话，一并撤销；客户端之后凭令牌恢复时只收到通知，不会回到频道。
+    """
+    resume_token = reserved_usernames.get((channel_id, username))
+    if resume_token is None:
+        return False
+    
+    drop_revoked_session(resume_token, channel_id, mode, notice)
+    backplane.publish({"op": "revoke", "token": resume_token, "channel": channel_id, "mode": mode, "notice": notice})
+    return True
+
+def drop_revoked_session(resume_token, channel_id, mode, notice):
+    """移除被撤销的待恢复会话并记下通知，会话由本节点保留时释放其用户名"""
+    session = drop_session(resume_token)
+    if session is not None:
+        username, channel, _, _, timer = session
+        if timer is not None:
+            backplane.release(channel, username)
+    
+    revoked_sessions[resume_token] = (channel_id, mode, notice)
+    asyncio.get_running_loop().call_later(RESUME_GRACE_PERIOD, revoked_sessions.pop, resume_token, None)
+
+def revoke_channel_sessions(channel_id, exclude_username, mode, notice):
+    """撤销频道中除指定用户外所有等待恢复的会话，返回撤销的数量"""
+    return sum(revoke_session(channel_id, username, mode, notice)
+               for channel, username in list(reserved_usernames)
+               if channel == channel_id and username != exclude_username)
+
+def resume_session(resume_token):
+    """取出待恢复的会话，返回 (用户名, 频道, 是否管理员, 历史序号编号)，令牌无效或已过期时返回 None"""
+    session = drop_session(resume_token)
+    if session is None:
+        return None
+    
+    backplane.publish({"op": "resumed", "token": resume_token})
+    username, channel, is_admin, epoch, _ = session
+    return username, channel, is_admin, epoch
+
+def expire_session(resume_token):
+    """宽限期结束仍未恢复的会话，释放用户名并广播用户断开连接"""
+    session = drop_session(resume_token)
+    if session is None:
+        return
+    
+    backplane.publish({"op": "expired", "token": resume_token})
+    username, channel, _, _, _ = session
+    backplane.release(channel, username)
+    announce_presence(channel, username, "leave")
 
 async def send_private_message(websocket, message_data):
     """向指定用户发送私信"""
-    message_data["time"] = datetime.now().strftime("%H:%M:%S")
-    message_json = json.dumps(message_data)
+    message_data["time"] = current_time()
+    message_json = dumps(message_data)
     
-    try:
-        await websocket.send(message_json)
-    except websockets.exceptions.ConnectionClosed:
-        # 移除已关闭的连接
-        if websocket in connection_map:
-            username, channel, is_admin = connection_map[websocket]
-            if username in channels[channel]:
-                del channels[channel][username]
-            del connection_map[websocket]
-
-async def handle_admin_command(websocket, command, admin_username):
+    send_frame(websocket, message_json)
+
+async def send_to_user(channel_id, username, message_data):
+    """向指定频道的用户发送私信，用户可能位于其他节点"""
+    session = channels[channel_id].get(username)
+    if session is not None:
+        await send_private_message(session.websocket, message_data)
+        return
+    
+    message_data["time"] = current_time()
+    backplane.publish({"op": "say", "channel": channel_id, "username": username, "frame": dumps(message_data)})
+
+async def is_user_online(channel_id, username):
+    """检查用户是否在指定频道中在线（包括其他节点）"""
+    if username in channels[channel_id]:
+        return True
+    return channel_id in await backplane.locate(username)
+
+async def locate_user(channel_id, username):
+    """确定目标用户所在的频道，频道ID为 * 时从全服索引中查找，返回 (频道, 错误信息)"""
+    if channel_id != ANY_CHANNEL:
+        if channel_id in ALLOWED_CHANNELS and await is_user_online(channel_id, username):
+            return channel_id, None
+        return None, f"用户 '{username}' 不在频道 '{channel_id}' 中"
+    
+    user_channels = await backplane.locate(username)
+    if not user_channels:
+        return None, f"用户 '{username}' 不在线"
+    if len(user_channels) > 1:
+        return None, f"用户 '{username}' 同时在频道 {', '.join(user_channels)} 中，请指定频道"
+    return user_channels[0], None
+
+def kick_user(channel_id, username, notice):
+    """将本节点中的用户移出频道但保留连接并通知该用户，返回其会话（不在本节点时返回 None）"""
+    session = leave_channel(channel_id, username)
+    if session is None:
+        return None
+    
+    # 用户不再属于任何频道，重新选择频道前不能发送消息
+    session.channel = None
+    
+    # 通知被踢用户
+    send_message(session.websocket, {
+        "type": "system",
+        "channel": channel_id,
+        "message": notice
+    })
+    return session
+
+def disconnect_user(channel_id, username, notice):
+    """断开本节点中用户的连接，通知发出后再关闭，返回其会话（不在本节点时返回 None）"""
+    session = leave_channel(channel_id, username)
+    if session is None:
+        return None
+    
+    # 连接处理结束时不再重复清理
+    session.channel = None
+    
+    # 通知用户连接将被断开
+    send_message(session.websocket, {
+        "type": "system",
+        "channel": channel_id,
+        "message": notice
+    })
+    
+    # 发送队列中的通知发出后关闭用户连接
+    session.outbox.close()
+    return session
+
+# 管理员清理用户的方式：{模式: 处理函数}
+EVICT_HANDLERS = {
+    "kick": kick_user,
+    "close": disconnect_user
+}
+
+def evict_user(channel_id, username, mode, notice):
+    """踢出或断开指定用户，用户不在本节点时交给其他节点处理；返回用户是否正在断线等待恢复（其会话已撤销）"""
+    if revoke_session(channel_id, username, mode, notice):
+        return True
+    if EVICT_HANDLERS[mode](channel_id, username, notice) is None:
+        backplane.publish({"op": "evict", "channel": channel_id, "username": username, "mode": mode, "notice": notice})
+    return False
+
+def evict_local_channel(channel_id, exclude_username, mode, notice):
+    """踢出或断开本节点中频道除指定用户外的所有用户，返回被处理的会话列表
+
+    频道成员表和各会话在返回前已全部同步更新，通知和关闭由各连接的写任务并发完成。
+    """
+    return [EVICT_HANDLERS[mode](channel_id, username, notice)
+            for username in list(channels[channel_id]) if username != exclude_username]
+
+def evict_channel(channel_id, exclude_username, mode, notice):
+    """踢出或断开频道中除指定用户外的所有用户（包括其他节点中的用户和断线等待恢复的用户）
+
+    返回 (本节点被处理的会话列表, 撤销的待恢复会话数)。
+    """
+    revoked = revoke_channel_sessions(channel_id, exclude_username, mode, notice)
+    evicted = evict_local_channel(channel_id, exclude_username, mode, notice)
+    backplane.publish({"op": "evict_channel", "channel": channel_id, "exclude": exclude_username,
+                       "mode": mode, "notice": notice})
+    return evicted, revoked
+
+async def wait_for_closures(sessions_to_close, report_progress):
+    """在统一时限内等待一批连接完成关闭，超时未关闭的强制断开，返回 (正常关闭数, 强制断开数)"""
+    closing = {session.outbox.task: session.websocket for session in sessions_to_close}  # {写任务: 连接}
+    
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + EVICT_GRACE_PERIOD
+    pending = set(closing)
+    while pending:
+        timeout = deadline - loop.time()
+        if timeout <= 0:
+            break
+        _, pending = await asyncio.wait(pending, timeout=min(timeout, EVICT_PROGRESS_INTERVAL))
+        if pending:
+            report_progress(len(sessions_to_close) - len(pending), len(sessions_to_close))
+    
+    # 超过时限仍未完成关闭握手的连接直接断开
+    for task in pending:
+        task.cancel()
+        closing[task].transport.abort()
+    return len(sessions_to_close) - len(pending), len(pending)
+
+async def finish_channel_close(admin_websocket, admin_channel, channel_id, evicted, revoked, total):
+    """等待关闭频道时断开的连接全部关闭，并向管理员报告进度和结果"""
+    def report_progress(done, local_total):
+        send_message(admin_websocket, {
+            "type": "system",
+            "channel": admin_channel,
+            "message": f"正在关闭频道 '{channel_id}'：已断开 {done}/{local_total} 个连接"
+        })
+    
+    closed, forced = await wait_for_closures(evicted, report_progress)
+    
+    summary = f"{closed} 个正常关闭，{forced} 个超时强制断开"
+    if revoked:
+        summary += f"，{revoked} 个断线等待恢复的会话已撤销"
+    if total > len(evicted) + revoked:
+        # 其余用户连接在其他节点上
+        summary += f"，{total - len(evicted) - revoked} 个不在本节点连接"
+    send_message(admin_websocket, {
+        "type": "system",
+        "channel": admin_channel,
+        "message": f"已关闭频道 '{channel_id}'，共断开 {total} 名用户的连接（{summary}）"
+    })
+
+def handle_backplane_message(message):
+    """处理其他节点经集群背板转发来的消息"""
+    op = message.get("op")
+    channel_id = message.get("channel")
+    
+    if op == "broadcast":
+        deliver_broadcast(channel_id, message["frame"])
+    elif op == "presence":
+        deliver_presence(channel_id, message["joined"], message["left"])
+    elif op == "say":
+        session = channels[channel_id].get(message["username"])
+        if session is not None:
+            send_frame(session.websocket, message["frame"])
+    elif op == "evict":
+        EVICT_HANDLERS[message["mode"]](channel_id, message["username"], message["notice"])
+    elif op == "evict_channel":
+        evicted = evict_local_channel(channel_id, message["exclude"], message["mode"], message["notice"])
+        if message["mode"] == "close":
+            # 与发起节点使用相同的关闭时限，结果由发起节点汇总报告
+            run_in_background(wait_for_closures(evicted, lambda done, total: None))
+    elif op == "suspend":
+        # 其他节点保留的会话，由原节点负责宽限期结束后的清理
+        suspended_sessions[message["token"]] = (message["username"], channel_id, message["is_admin"],
+                                                message["epoch"], None)
+        reserved_usernames[(channel_id, message["username"])] = message["token"]
+    elif op == "revoke":
+        drop_revoked_session(message["token"], channel_id, message["mode"], message["notice"])
+    elif op in ("resumed", "expired"):
+        drop_session(message["token"])
+
+async def handle_admin_command(session, command):
     """处理管理员命令"""
+    websocket = session.websocket
+    current_username = session.username
+    current_channel = session.channel or "unknown"
+    
     parts = command.strip().split(maxsplit=3)
     if not parts or parts[0] not in ['::kicks', '::kick', '::closes', '::close', '::lists', '::say']:
-        await websocket.send(json.dumps({
-            "type": "error",
-            "channel": connection_map[websocket][1],
-            "message": "无效的管理员命令"
-        }))
+        send_static(websocket, "error", current_channel, "无效的管理员命令")
         return
     
     cmd = parts[0]
-    current_username, current_channel, _ = connection_map[websocket]
     
     # 处理查看全服用户命令
     if cmd == '::lists':
-        all_users = []
-        for channel, users in channels.items():
-            for user in users:
-                all_users.append(f"{user}@{channel}")
+        if len(parts) > 1 and not (parts[1].isdigit() and int(parts[1]) > 0):
+            send_static(websocket, "error", current_channel, "命令格式应为 ::lists [页码]")
+            return
+        
+        # 从全服用户索引分页读取
+        page_number = int(parts[1]) if len(parts) > 1 else 1
+        result = await backplane.page((page_number - 1) * LISTS_PAGE_SIZE, LISTS_PAGE_SIZE)
         
-        if all_users:
-            user_list = "    ".join(all_users)  # 4个空格分隔
-            await websocket.send(json.dumps({
+        if result["total"]:
+            page_count = (result["total"] + LISTS_PAGE_SIZE - 1) // LISTS_PAGE_SIZE
+            channel_counts = "  ".join(f"{channel}: {count}" for channel, count in result["counts"].items())
+            user_list = "    ".join(f"{user}@{channel}" for user, channel in result["users"])  # 4个空格分隔
+            send_message(websocket, {
                 "type": "user_list",
                 "channel": current_channel,
-                "message": f"全服在线用户 ({len(all_users)}):",
+                "message": f"全服在线用户 ({result['total']}，第 {page_number}/{page_count} 页，{channel_counts}):",
                 "users": user_list
-            }))
+            })
         else:
-            await websocket.send(json.dumps({
-                "type": "system",
-                "channel": current_channel,
-                "message": "当前没有在线用户"
-            }))
+            send_static(websocket, "system", current_channel, "当前没有在线用户")
         return
     
     # 处理私信命令
     if cmd == '::say':
         if len(parts) < 4:
-            await websocket.send(json.dumps({
-                "type": "error",
-                "channel": current_channel,
-                "message": '命令格式应为 ::say [频道id] [用户名] [消息，用"包裹"]'
-            }))
+            send_static(websocket, "error", current_channel, '命令格式应为 ::say [频道id] [用户名] [消息，用"包裹"]')
             return
             
         target_channel = parts[1]
@@ -107,19 +923,17 @@ async def handle_admin_command(websocket, command, admin_username):
             message_content = message_content[1:-1]
         
         # 检查目标用户是否存在
-        if target_channel not in channels or target_user not in channels[target_channel]:
-            await websocket.send(json.dumps({
+        target_channel, error = await locate_user(target_channel, target_user)
+        if error:
+            send_message(websocket, {
                 "type": "error",
                 "channel": current_channel,
-                "message": f"用户 {target_user} 不在频道 {target_channel} 中"
-            }))
+                "message": error
+            })
             return
             
-        # 获取目标用户的连接
-        target_websocket = channels[target_channel][target_user]
-        
         # 发送私信给目标用户
-        await send_private_message(target_websocket, {
+        await send_to_user(target_channel, target_user, {
             "type": "message",
             "channel": target_channel,
             "username": f"管理员 {current_username}",
@@ -127,38 +941,27 @@ async def handle_admin_command(websocket, command, admin_username):
         })
         
         # 向管理员确认消息已发送
-        await websocket.send(json.dumps({
+        send_message(websocket, {
             "type": "system",
             "channel": current_channel,
             "message": f"已向频道 {target_channel} 的用户 {target_user} 发送私信"
-        }))
+        })
         return
     
     # 验证频道是否存在
     if len(parts) < 2:
-        await websocket.send(json.dumps({
-            "type": "error",
-            "channel": current_channel,
-            "message": "请指定频道ID"
-        }))
+        send_static(websocket, "error", current_channel, "请指定频道ID")
         return
         
     channel_id = parts[1]
-    if channel_id not in channels and cmd not in ['::close', '::closes']:
-        await websocket.send(json.dumps({
-            "type": "error",
-            "channel": current_channel,
-            "message": f"频道 '{channel_id}' 不存在"
-        }))
+    if channel_id not in ALLOWED_CHANNELS and cmd not in ['::close', '::closes'] and \
+            not (cmd == '::kicks' and channel_id == ANY_CHANNEL):
+        send_reply(websocket, "error", current_channel, f"频道 '{echo_text(channel_id)}' 不存在")
         return
     
     # 验证是否提供了理由
     if len(parts) < 3:
-        await websocket.send(json.dumps({
-            "type": "error",
-            "channel": current_channel,
-            "message": "请提供操作理由"
-        }))
+        send_static(websocket, "error", current_channel, "请提供操作理由")
         return
     
     reason = ' '.join(parts[2:])
@@ -166,49 +969,28 @@ async def handle_admin_command(websocket, command, admin_username):
     # 处理踢出单个用户命令
     if cmd == '::kicks':
         if len(parts) < 3:
-            await websocket.send(json.dumps({
-                "type": "error",
-                "channel": current_channel,
-                "message": "命令格式应为 ::kicks [频道id] [用户名] [理由]"
-            }))
+            send_static(websocket, "error", current_channel, "命令格式应为 ::kicks [频道id] [用户名] [理由]")
             return
             
         username = parts[2]
         reason = ' '.join(parts[3:]) if len(parts) > 3 else "无理由"
         
-        if username not in channels[channel_id]:
-            await websocket.send(json.dumps({
+        channel_id, error = await locate_user(channel_id, username)
+        if error:
+            send_message(websocket, {
                 "type": "error",
                 "channel": current_channel,
-                "message": f"用户 '{username}' 不在频道 '{channel_id}' 中"
-            }))
+                "message": error
+            })
             return
             
         # 不能踢自己
         if username == current_username:
-            await websocket.send(json.dumps({
-                "type": "error",
-                "channel": current_channel,
-                "message": "不能踢自己"
-            }))
+            send_static(websocket, "error", current_channel, "不能踢自己")
             return
             
-        # 获取用户连接
-        user_websocket = channels[channel_id][username]
-        
-        # 从频道移除用户
-        del channels[channel_id][username]
-        
-        # 更新连接映射
-        if user_websocket in connection_map:
-            connection_map[user_websocket] = (username, "public", False)
-        
-        # 通知被踢用户
-        await user_websocket.send(json.dumps({
-            "type": "system",
-            "channel": channel_id,
-            "message": f"您已从频道被踢出，{reason}"
-        }))
+        # 从频道移除用户并通知被踢用户
+        revoked = evict_user(channel_id, username, "kick", f"您已从频道被踢出，{reason}")
         
         # 广播用户被踢消息
         await broadcast(channel_id, {
@@ -217,50 +999,34 @@ async def handle_admin_command(websocket, command, admin_username):
         })
         
         # 通知管理员操作成功
-        await websocket.send(json.dumps({
+        send_message(websocket, {
             "type": "system",
             "channel": current_channel,
-            "message": f"已将用户 {username} 从频道 {channel_id} 踢出"
-        }))
+            "message": f"已将用户 {username} 从频道 {channel_id} 踢出" +
+                       ("（该用户正在断线等待恢复，已撤销其会话）" if revoked else "")
+        })
         return
     
     # 处理清退频道所有用户命令
     if cmd == '::kick':
-        if not channels[channel_id]:
-            await websocket.send(json.dumps({
-                "type": "error",
-                "channel": current_channel,
-                "message": f"频道 '{channel_id}' 中没有用户"
-            }))
+        users_to_kick = await backplane.members(channel_id)
+        if not users_to_kick:
+            send_reply(websocket, "error", current_channel, f"频道 '{echo_text(channel_id)}' 中没有用户")
             return
             
         # 保存要踢出的用户
-        users_to_kick = list(channels[channel_id].items())
-        kicked_users = [user for user, _ in users_to_kick if user != current_username]
+        kicked_users = [user for user in users_to_kick if user != current_username]
         
         if not kicked_users:
-            await websocket.send(json.dumps({
+            send_message(websocket, {
                 "type": "system",
                 "channel": current_channel,
                 "message": f"频道 '{channel_id}' 中只有您自己，无需清退"
-            }))
+            })
             return
             
-        # 踢出所有非管理员用户
-        for username, websocket in users_to_kick:
-            if username != current_username:  # 保留管理员
-                del channels[channel_id][username]
-                
-                # 更新连接映射
-                if websocket in connection_map:
-                    connection_map[websocket] = (username, "public", False)
-                
-                # 通知被踢用户
-                await websocket.send(json.dumps({
-                    "type": "system",
-                    "channel": channel_id,
-                    "message": f"该频道已被清退，{reason}"
-                }))
+        # 踢出所有非管理员用户（保留管理员）
+        _, revoked = evict_channel(channel_id, current_username, "kick", f"该频道已被清退，{reason}")
         
         # 广播清退消息
         await broadcast(channel_id, {
@@ -269,67 +1035,39 @@ async def handle_admin_command(websocket, command, admin_username):
         })
         
         # 通知管理员操作成功
-        await websocket.send(json.dumps({
+        send_message(websocket, {
             "type": "system",
             "channel": current_channel,
-            "message": f"已清退频道 '{channel_id}' 中的 {len(kicked_users)} 名用户"
-        }))
+            "message": f"已清退频道 '{channel_id}' 中的 {len(kicked_users)} 名用户" +
+                       (f"，其中 {revoked} 名正在断线等待恢复，已撤销其会话" if revoked else "")
+        })
         return
     
     # 处理断开单个用户连接命令
     if cmd == '::closes':
         if len(parts) < 3:
-            await websocket.send(json.dumps({
-                "type": "error",
-                "channel": current_channel,
-                "message": "命令格式应为 ::closes [频道id] [用户名] [理由]"
-            }))
+            send_static(websocket, "error", current_channel, "命令格式应为 ::closes [频道id] [用户名] [理由]")
             return
             
         username = parts[2]
         reason = ' '.join(parts[3:]) if len(parts) > 3 else "无理由"
         
-        if username not in channels[channel_id]:
-            await websocket.send(json.dumps({
+        channel_id, error = await locate_user(channel_id, username)
+        if error:
+            send_message(websocket, {
                 "type": "error",
                 "channel": current_channel,
-                "message": f"用户 '{username}' 不在频道 '{channel_id}' 中"
-            }))
+                "message": error
+            })
             return
             
         # 不能断开自己的连接
         if username == current_username:
-            await websocket.send(json.dumps({
-                "type": "error",
-                "channel": current_channel,
-                "message": "不能断开自己的连接"
-            }))
+            send_static(websocket, "error", current_channel, "不能断开自己的连接")
             return
             
-        # 获取用户连接
-        user_websocket = channels[channel_id][username]
-        
-        # 从频道移除用户
-        del channels[channel_id][username]
-        
-        # 从连接映射移除
-        if user_websocket in connection_map:
-            del connection_map[user_websocket]
-        
-        # 通知用户连接将被断开
-        try:
-            await user_websocket.send(json.dumps({
-                "type": "system",
-                "channel": channel_id,
-                "message": f"您的连接已被主动断开，{reason}"
-            }))
-            # 等待消息发送
-            await asyncio.sleep(0.1)
-        except:
-            pass
-        
-        # 关闭用户连接
-        await user_websocket.close()
+        # 通知用户并断开其连接
+        revoked = evict_user(channel_id, username, "close", f"您的连接已被主动断开，{reason}")
         
         # 广播用户被断开连接消息
         await broadcast(channel_id, {
@@ -338,354 +1076,677 @@ async def handle_admin_command(websocket, command, admin_username):
         })
         
         # 通知管理员操作成功
-        await websocket.send(json.dumps({
+        send_message(websocket, {
             "type": "system",
             "channel": current_channel,
-            "message": f"已断开用户 {username} 的连接"
-        }))
+            "message": f"已断开用户 {username} 的连接" +
+                       ("（该用户正在断线等待恢复，已撤销其会话）" if revoked else "")
+        })
         return
     
     # 处理关闭频道命令
     if cmd == '::close':
-        if not channels[channel_id]:
-            await websocket.send(json.dumps({
-                "type": "error",
-                "channel": current_channel,
-                "message": f"频道 '{channel_id}' 中没有用户"
-            }))
+        users_to_disconnect = await backplane.members(channel_id)
+        if not users_to_disconnect:
+            send_reply(websocket, "error", current_channel, f"频道 '{echo_text(channel_id)}' 中没有用户")
             return
             
         # 保存要断开连接的用户
-        users_to_disconnect = list(channels[channel_id].items())
-        disconnected_users = [user for user, _ in users_to_disconnect if user != current_username]
+        disconnected_users = [user for user in users_to_disconnect if user != current_username]
         
-        # 断开所有非管理员用户的连接
-        for username, websocket in users_to_disconnect:
-            if username != current_username:  # 保留管理员
-                # 从频道移除用户
-                del channels[channel_id][username]
-                
-                # 从连接映射移除
-                if websocket in connection_map:
-                    del connection_map[websocket]
-                
-                # 通知用户连接将被断开
-                try:
-                    await websocket.send(json.dumps({
-                        "type": "system",
-                        "channel": channel_id,
-                        "message": f"该频道被封禁，{reason}"
-                    }))
-                    # 等待消息发送
-                    await asyncio.sleep(0.1)
-                except:
-                    pass
-                
-                # 关闭用户连接
-                await websocket.close()
+        # 断开所有非管理员用户的连接（保留管理员），通知和关闭并发进行
+        evicted, revoked = evict_channel(channel_id, current_username, "close", f"该频道被封禁，{reason}")
         
-        # 通知管理员操作成功
-        await websocket.send(json.dumps({
+        send_message(websocket, {
             "type": "system",
             "channel": current_channel,
-            "message": f"已关闭频道 '{channel_id}'，共断开 {len(disconnected_users)} 名用户的连接"
-        }))
+            "message": f"正在关闭频道 '{channel_id}'，共 {len(disconnected_users)} 名用户，等待连接关闭"
+        })
+        
+        # 在后台等待连接关闭并报告结果，不阻塞管理员的连接
+        run_in_background(finish_channel_close(websocket, current_channel, channel_id,
+                                               evicted, revoked, len(disconnected_users)))
+        return
+
+class Session:
+    """单个客户端连接的会话：所有代码路径共用的唯一连接状态，频道成员表中保存的也是它
+
+    使用 __slots__ 不为每个实例分配属性字典，减少每个连接占用的内存。
+    """
+
+    __slots__ = ("websocket", "outbox", "username", "channel", "is_admin", "login_completed", "awaiting_request",
+                 "resume_token", "message_bucket", "connected_at", "last_seen", "last_pong", "ping_sent", "ping_waiter")
+
+    def __init__(self, websocket):
+        self.websocket = websocket
+        self.outbox = Outbox(websocket)  # 发送队列和写任务
+        self.username = None
+        self.channel = None
+        self.is_admin = False
+        self.login_completed = False  # 跟踪登录流程是否完成
+        self.awaiting_request = True  # 是否计入 pending_logins：首个请求尚未处理完且接入未超过 PENDING_LOGIN_WINDOW
+        self.resume_token = None  # 断线后恢复会话使用的令牌
+        # 连接的消息令牌桶，None 表示不限制
+        self.message_bucket = TokenBucket(RATE_LIMIT_CONNECTION) if RATE_LIMIT_CONNECTION is not None else None
+        self.connected_at = time.monotonic()
+        self.last_seen = self.connected_at  # 最近一次收到客户端请求的时间
+        self.last_pong = self.connected_at  # 最近一次确认收到心跳 pong 的时间
+        self.ping_sent = None  # 尚未收到 pong 的心跳发出时间，None 表示没有等待中的心跳
+        self.ping_waiter = None  # 等待 pong 的 Future
+
+def settle_pending_login(session):
+    """连接的首个请求已处理完、接入已超过 PENDING_LOGIN_WINDOW 或连接已关闭，不再计入 pending_logins"""
+    global pending_logins
+    if session.awaiting_request:
+        session.awaiting_request = False
+        pending_logins -= 1
+
+def complete_login(session):
+    """标记连接已完成登录"""
+    session.login_completed = True
+
+# 管理员登录成功时下发的命令说明
+ADMIN_COMMANDS = [
+    "::kicks [频道id|*] [用户名] [理由] - 踢出指定频道中的指定用户",
+    "::kick [频道id] [理由] - 清退指定频道中的所有用户",
+    "::closes [频道id|*] [用户名] [理由] - 断开指定用户的连接",
+    "::close [频道id] [理由] - 关闭频道并断开所有用户连接",
+    "::lists [页码] - 分页查看全服在线用户名",
+    '::say [频道id|*] [用户名] [消息，用"包裹"] - 向指定用户发送私信',
+    "频道id 填 * 时按用户名在全服查找其所在频道"
+]
+
+async def handle_login(session, data):
+    """处理登录请求"""
+    websocket = session.websocket
+    username = data.get('username')
+    channel = data.get('channel')
+    
+    if not username or not channel:
+        send_result(websocket, data, {"type": "error", "channel": echo_text(channel or "unknown"),
+                                      "message": "用户名和频道不能为空"})
+        return
+    
+    # 验证频道是否允许
+    if channel not in ALLOWED_CHANNELS:
+        send_result(websocket, data, {"type": "error", "channel": echo_text(channel),
+                                      "message": f"频道 '{echo_text(channel)}' 不被允许"})
+        return
+    
+    # 处理管理员登录
+    admin_login = username.lower() == 'administrator'
+    if admin_login:
+        # 检查是否提供了密码哈希
+        password_hash = data.get('password_hash')
+        if not password_hash:
+            # 请求密码
+            send_result(websocket, data, {"type": "require_password", "channel": channel, "message": "管理员登录需要密码"})
+            return
+        
+        # 验证密码哈希
+        if password_hash != ADMIN_PASSWORD_HASH:
+            send_result(websocket, data, {"type": "error", "channel": channel, "message": "密码错误，无法登录管理员账号"})
+            return
+        
+        # 密码验证成功，设置为管理员
+        session.is_admin = True
+    
+    # 用户名存在性检查逻辑（同时在集群中占用该用户名）
+    username_exists = not await claim_username(channel, username, session)
+    
+    if username_exists:
+        send_result(websocket, data, {
+            "type": "error",
+            "channel": channel,
+            "message": f"用户名 '{username}' 在频道 '{channel}' 中已存在，请更换用户名"
+        })
+        return
+    
+    # 如果用户之前在其他频道，先移除（用户名和频道都未变时保留刚占用的用户名）
+    if in_channel(session):
+        leave_channel(session.channel, session.username,
+                      release=(session.channel, session.username) != (channel, username))
+        announce_presence(session.channel, session.username, "leave")
+    
+    # 更新当前用户信息
+    session.username = username
+    session.channel = channel
+    
+    # 添加用户到频道
+    join_channel(session.channel, session.username, session)
+    
+    # 标记登录完成
+    complete_login(session)
+    
+    # 生成恢复令牌，断线后可凭此令牌恢复会话
+    session.resume_token = secrets.token_urlsafe(16)
+    
+    # 发送登录成功消息
+    login_msg = {
+        "type": "system",
+        "channel": session.channel,
+        "message": f"成功登录，用户名: {session.username}",
+        "resume_token": session.resume_token
+    }
+    
+    # 如果是管理员，添加管理员命令列表
+    if session.is_admin:
+        login_msg["admin_commands"] = ADMIN_COMMANDS
+    
+    send_result(websocket, data, login_msg)
+    
+    # 按请求回放频道历史消息
+    send_history(websocket, session.channel, data.get('history'))
+    
+    # 记录用户加入，合并窗口结束后统一广播
+    announce_presence(session.channel, session.username, "join")
+
+async def handle_choose(session, data):
+    """处理频道选择请求"""
+    websocket = session.websocket
+    if not session.username:
+        # 获取用户名（可能是自动生成的）
+        session.username = data.get('username')
+        if not session.username:
+            send_result(websocket, data, {"type": "error", "channel": echo_text(data.get('new_channel') or "unknown"),
+                                          "message": "请先登录设置用户名"})
+            return
+        
+    new_channel = data.get('new_channel')
+    
+    if not new_channel:
+        send_result(websocket, data, {"type": "error", "channel": session.channel or "unknown", "message": "频道ID不能为空"})
         return
+    
+    # 验证新频道是否允许
+    if new_channel not in ALLOWED_CHANNELS:
+        send_result(websocket, data, {"type": "error", "channel": echo_text(new_channel),
+                                      "message": f"频道 '{echo_text(new_channel)}' 不被允许"})
+        return
+    
+    # 验证用户名在新频道是否已存在（同时在集群中占用该用户名）
+    if new_channel != session.channel and not await claim_username(new_channel, session.username, session):
+        send_result(websocket, data, {
+            "type": "error",
+            "channel": new_channel,
+            "message": f"用户名 '{session.username}' 在频道 '{new_channel}' 中已存在，请更换用户名"
+        })
+        return
+    
+    # 从旧频道移除用户
+    if in_channel(session):
+        leave_channel(session.channel, session.username, release=new_channel != session.channel)
+        announce_presence(session.channel, session.username, "leave")
+    
+    # 更新当前频道
+    session.channel = new_channel
+    join_channel(session.channel, session.username, session)
+    
+    # 按请求回放频道历史消息
+    send_history(websocket, session.channel, data.get('history'))
+    
+    # 记录用户加入新频道，合并窗口结束后统一广播
+    announce_presence(session.channel, session.username, "join")
+    
+    # 通知用户切换成功
+    send_result(websocket, data, {"type": "system", "channel": session.channel, "message": f"已切换到频道 '{session.channel}'"})
+
+async def handle_resume(session, data):
+    """处理断线后的会话恢复请求"""
+    websocket = session.websocket
+    suspended = None
+    if not session.username:
+        revoked = revoked_sessions.pop(data.get('resume_token'), None)
+        if revoked is not None:
+            # 断线期间被管理员踢出或断开：补发通知，不恢复会话
+            channel_id, mode, notice = revoked
+            send_message(websocket, {"type": "system", "channel": channel_id, "message": notice})
+            if mode == "close":
+                session.outbox.close()
+            else:
+                send_static(websocket, "resume_failed", channel_id, "会话已被管理员撤销，请重新登录")
+            return
+        suspended = resume_session(data.get('resume_token'))
+    
+    if suspended is None:
+        send_static(websocket, "resume_failed", session.channel or "unknown", "会话已过期或令牌无效，请重新登录")
+        return
+    
+    # 静默恢复用户名和频道，不广播离开和加入消息
+    session.username, session.channel, session.is_admin, epoch = suspended
+    backplane.takeover(session.channel, session.username)
+    join_channel(session.channel, session.username, session)
+    complete_login(session)
+    session.resume_token = secrets.token_urlsafe(16)
+    
+    send_message(websocket, {
+        "type": "resumed",
+        "channel": session.channel,
+        "username": session.username,
+        "is_admin": session.is_admin,
+        "message": f"已恢复会话，用户名: {session.username}",
+        "resume_token": session.resume_token
+    })
+    
+    # 补发断线期间错过的消息；会话在其他节点或重启前的进程中断开时，客户端的序号在这里无效
+    send_history(websocket, session.channel, data.get('history'), epoch)
+
+async def handle_list_command(session, data):
+    """处理查看用户列表命令"""
+    websocket = session.websocket
+    channel_id = data.get('channel_id')
+    
+    if channel_id not in ALLOWED_CHANNELS:
+        send_reply(websocket, "error", session.channel or "unknown", f"频道 '{echo_text(channel_id)}' 不被允许或不存在")
+        return
+    
+    # 获取频道用户列表
+    users = await backplane.members(channel_id)
+    if users:
+        user_list = "    ".join(users)  # 4个空格分隔
+        send_message(websocket, {
+            "type": "user_list",
+            "channel": channel_id,
+            "message": f"频道 {channel_id} 在线用户 ({len(users)}):",
+            "users": user_list
+        })
+    else:
+        send_static(websocket, "system", session.channel or "unknown", f"频道 {channel_id} 中没有在线用户")
+
+async def handle_presence(session, data):
+    """处理查看最近成员变动的请求"""
+    if session.channel and session.login_completed:
+        send_presence(session.websocket, session.channel)
+
+async def handle_admin_request(session, data):
+    """处理管理员命令请求"""
+    if not session.is_admin:
+        send_static(session.websocket, "error", session.channel or "unknown", "你没有权限执行此命令")
+        return
+    
+    await handle_admin_command(session, data.get('command') or '')
+
+async def admit_message(session):
+    """在广播前执行发送频率限制，返回消息是否可以发送"""
+    wait = rate_limit_wait(session, time.monotonic())
+    if wait > 0:
+        if RATE_LIMIT_POLICY == "drop":
+            rate_limited.inc("dropped")
+            return False
+        if RATE_LIMIT_POLICY != "throttle" or wait > RATE_LIMIT_MAX_DELAY:
+            rate_limited.inc("rejected")
+            send_static(session.websocket, "error", session.channel, "发送消息过于频繁，请稍后再试")
+            return False
+        
+        # 延迟期间不读取该连接的后续请求，发送过快的客户端被自然限速
+        rate_limited.inc("throttled")
+        await asyncio.sleep(wait)
+        if not in_channel(session):
+            # 等待期间已被踢出或清退
+            return False
+        if rate_limit_wait(session, time.monotonic()) > 0:
+            # 等待期间频道令牌被其他成员取走
+            send_static(session.websocket, "error", session.channel, "发送消息过于频繁，请稍后再试")
+            return False
+    
+    consume_rate_limit(session)
+    return True
+
+async def handle_message(session, data):
+    """处理普通消息"""
+    if not session.username or not session.channel or not session.login_completed:
+        # 确保登录完成后才能发送消息
+        return
+        
+    message_text = (data.get('message') or '').strip()
+    if message_text:
+        if not await admit_message(session):
+            return
+        await broadcast(session.channel, {
+            "type": "message",
+            "username": session.username,
+            "message": message_text
+        })
+
+async def handle_leave(session, data):
+    """处理离开请求，返回 True 结束连接"""
+    if in_channel(session):
+        leave_channel(session.channel, session.username)
+        announce_presence(session.channel, session.username, "leave")
+    return True
+
+# 客户端请求的处理函数：{请求类型: 处理函数}，处理函数返回 True 时结束连接
+ACTION_HANDLERS = {
+    "login": handle_login,
+    "choose": handle_choose,
+    "resume": handle_resume,
+    "list_command": handle_list_command,
+    "presence": handle_presence,
+    "admin_command": handle_admin_request,
+    "message": handle_message,
+    "leave": handle_leave
+}
+
+
+def describe_action(action, data):
+    """慢请求日志中的请求类型，管理员命令按具体命令区分"""
+    if action == "admin_command":
+        return " ".join(["admin_command"] + (data.get('command') or '').split(maxsplit=1)[:1])
+    return action
+
+def check_connection(session, now):
+    """检查连接的登录、空闲和心跳超时，返回超时原因；未超时时返回 None 和下次检查的时间"""
+    deadlines = []
+    if session.awaiting_request:
+        deadline = session.connected_at + PENDING_LOGIN_WINDOW
+        if now >= deadline:
+            settle_pending_login(session)
+        else:
+            deadlines.append(deadline)
+    
+    # 以 ::choose 加入频道的连接没有经过登录，同样视为已登录
+    if not session.login_completed and not in_channel(session) and LOGIN_TIMEOUT is not None:
+        deadline = session.connected_at + LOGIN_TIMEOUT
+        if now >= deadline:
+            return "login", None
+        deadlines.append(deadline)
+    
+    if session.login_completed and IDLE_TIMEOUT is not None:
+        deadline = session.last_seen + IDLE_TIMEOUT
+        if now >= deadline:
+            return "idle", None
+        deadlines.append(deadline)
+    
+    if HEARTBEAT_INTERVAL is not None:
+        if session.ping_waiter is not None and session.ping_waiter.done():
+            session.last_pong = now
+            session.ping_sent = session.ping_waiter = None
+        if session.ping_sent is not None:
+            # 收到任何请求也说明连接仍然可用
+            if session.last_seen < session.ping_sent:
+                deadline = session.ping_sent + HEARTBEAT_TIMEOUT
+                if now >= deadline:
+                    return "heartbeat", None
+                deadlines.append(deadline)
+            else:
+                session.ping_sent = session.ping_waiter = None
+        if session.ping_sent is None:
+            deadline = max(session.last_seen, session.last_pong) + HEARTBEAT_INTERVAL
+            if now >= deadline:
+                session.ping_sent = now
+                run_in_background(send_heartbeat(session))
+                deadline = now + HEARTBEAT_TIMEOUT
+            deadlines.append(deadline)
+    
+    return None, min(deadlines) if deadlines else None
+
+async def send_heartbeat(session):
+    """发送心跳 ping，记录等待 pong 的 Future"""
+    try:
+        session.ping_waiter = await session.websocket.ping()
+    except websockets.exceptions.ConnectionClosed:
+        pass
+
+def reap_connections(expired):
+    """定时轮回调：批量检查到期的连接，清理超时的连接，其余连接登记下次检查"""
+    now = time.monotonic()
+    reaped = defaultdict(int)  # {超时原因: 连接数}
+    for session in expired:
+        reason, deadline = check_connection(session, now)
+        if reason is None:
+            if deadline is not None:
+                connection_wheel.schedule(session, deadline - now)
+            continue
+        
+        reaped[reason] += 1
+        connections_reaped.inc(reason)
+        websocket = session.websocket
+        
+        # 与意外断开的处理相同：有恢复令牌的会话保留到宽限期结束，否则广播离开
+        if in_channel(session):
+            leave_channel(session.channel, session.username, release=not session.resume_token)
+            if session.resume_token:
+                suspend_session(session.resume_token, session.username, session.channel, session.is_admin)
+            else:
+                announce_presence(session.channel, session.username, "leave")
+        # 会话已清理，连接处理结束时不再重复清理
+        session.username = session.channel = None
+        
+        if reason == "heartbeat":
+            # 对端已无响应，关闭握手只会等到超时，直接断开底层连接
+            websocket.transport.abort()
+        else:
+            close_connection(websocket, 1000, "登录超时" if reason == "login" else "空闲超时")
+    
+    if reaped:
+        names = {"login": "登录超时", "idle": "空闲超时", "heartbeat": "心跳超时"}
+        print("清理超时连接: " + "，".join(f"{count} 个{names[reason]}" for reason, count in reaped.items()))
+
+# 超时检查定时轮，所有连接共用一个任务
+connection_wheel = TimerWheel(TIMER_WHEEL_TICK, TIMER_WHEEL_SLOTS, reap_connections)
+
+def retry_after():
+    """被拒绝的客户端应等待的秒数，随机分散重试时间"""
+    return random.randint(ADMISSION_RETRY_AFTER, ADMISSION_RETRY_AFTER * 2)
+
+def admission_refusal(connection):
+    """按连接数、单 IP 连接数、等待首个请求的连接数和接受速率检查新连接，返回拒绝原因，允许时返回 None"""
+    if MAX_CONNECTIONS is not None and len(sessions) >= MAX_CONNECTIONS:
+        return "connections"
+    if MAX_CONNECTIONS_PER_IP is not None and \
+            connections_per_ip.get(connection.remote_address[0], 0) >= MAX_CONNECTIONS_PER_IP:
+        return "per_ip"
+    if MAX_PENDING_LOGINS is not None and pending_logins >= MAX_PENDING_LOGINS:
+        return "pending_logins"
+    if accept_bucket is not None:
+        if accept_bucket.wait_time(time.monotonic()) > 0:
+            return "accept_rate"
+        accept_bucket.tokens -= 1
+    return None
+
+def admit_connection(connection, request):
+    """握手前的准入检查，超过限制时直接回复 503 和 Retry-After，不建立 WebSocket 连接"""
+    reason = admission_refusal(connection)
+    if reason is None:
+        return None
+    
+    connections_rejected.inc(reason)
+    wait = retry_after()
+    response = connection.respond(503, f"服务器繁忙，请 {wait} 秒后重试\n")
+    response.headers["Retry-After"] = str(wait)
+    return response
+
+def serve_options():
+    """websockets.serve 的公共参数：子协议协商、准入控制和压缩"""
+    options = {"select_subprotocol": select_subprotocol,
+               "process_request": admit_connection,
+               "open_timeout": HANDSHAKE_TIMEOUT,
+               "compression": None}
+    if HEARTBEAT_INTERVAL is not None:
+        # 心跳由共用的定时轮发送，关闭每个连接各自的保活任务
+        options["ping_interval"] = None
+    if COMPRESSION_ENABLED:
+        options["extensions"] = deflate_extensions(COMPRESSION_WINDOW_BITS, COMPRESSION_MEMORY_LEVEL,
+                                                   COMPRESSION_MIN_SIZE, COMPRESSION_SHARED)
+    return options
 
 async def handle_client(websocket):
     """处理单个客户端的连接逻辑"""
-    current_username = None
-    current_channel = None
-    is_admin = False
-    login_completed = False  # 跟踪登录流程是否完成
+    global pending_logins
+    # 同时完成握手的连接可能一起通过准入检查，超出上限的以 1013 关闭并提示重试时间
+    if MAX_CONNECTIONS is not None and len(sessions) >= MAX_CONNECTIONS:
+        connections_rejected.inc("connections")
+        await websocket.close(1013, f"服务器繁忙，请 {retry_after()} 秒后重试")
+        return
+    
+    # 创建会话，同时为连接创建发送队列和写任务
+    session = Session(websocket)
+    sessions[websocket] = session
+    connections_accepted.inc()
+    client_ip = websocket.remote_address[0]
+    connections_per_ip[client_ip] += 1
+    pending_logins += 1
+    first_check = check_connection(session, session.connected_at)[1]
+    if first_check is not None:
+        connection_wheel.schedule(session, first_check - session.connected_at)
+    
+    # 二进制连接先收到频道表，之后的消息以编号表示频道
+    if session.outbox.binary:
+        session.outbox.put(channel_table_frame)
     
     try:
         while True:
             # 接收客户端消息
             message = await websocket.recv()
-            data = json.loads(message)
+            session.last_seen = time.monotonic()
+            if SLOW_HANDLER_THRESHOLD is not None:
+                handler_started = session.last_seen
             
-            # 处理登录请求
-            if data.get('action') == 'login':
-                username = data.get('username')
-                channel = data.get('channel')
-                
-                if not username or not channel:
-                    await websocket.send(json.dumps({
-                        "type": "error",
-                        "channel": channel or "unknown",
-                        "message": "用户名和频道不能为空"
-                    }))
-                    continue
-                
-                # 验证频道是否允许
-                if channel not in ALLOWED_CHANNELS:
-                    await websocket.send(json.dumps({
-                        "type": "error",
-                        "channel": channel,
-                        "message": f"频道 '{channel}' 不被允许"
-                    }))
-                    continue
-                
-                # 处理管理员登录
-                admin_login = username.lower() == 'administrator'
-                if admin_login:
-                    # 检查是否提供了密码哈希
-                    password_hash = data.get('password_hash')
-                    if not password_hash:
-                        # 请求密码
-                        await websocket.send(json.dumps({
-                            "type": "require_password",
-                            "channel": channel,
-                            "message": "管理员登录需要密码"
-                        }))
-                        continue
-                    
-                    # 验证密码哈希
-                    if password_hash != ADMIN_PASSWORD_HASH:
-                        await websocket.send(json.dumps({
-                            "type": "error",
-                            "channel": channel,
-                            "message": "密码错误，无法登录管理员账号"
-                        }))
-                        continue
-                    
-                    # 密码验证成功，设置为管理员
-                    is_admin = True
-                
-                # 用户名存在性检查逻辑
-                username_exists = False
-                if channel in channels and username in channels[channel]:
-                    # 检查该用户名是否属于当前连接
-                    existing_connection = channels[channel][username]
-                    if existing_connection != websocket:
-                        username_exists = True
-                
-                if username_exists:
-                    await websocket.send(json.dumps({
-                        "type": "error",
-                        "channel": channel,
-                        "message": f"用户名 '{username}' 在频道 '{channel}' 中已存在，请更换用户名"
-                    }))
-                    continue
-                
-                # 如果用户之前在其他频道，先移除
-                if current_username and current_channel and current_username in channels[current_channel]:
-                    del channels[current_channel][current_username]
-                    await broadcast(current_channel, {
-                        "type": "system",
-                        "message": f"{current_username} 离开了频道"
-                    })
-                
-                # 更新当前用户信息
-                current_username = username
-                current_channel = channel
-                
-                # 添加用户到频道
-                channels[current_channel][current_username] = websocket
-                
-                # 更新连接映射
-                connection_map[websocket] = (current_username, current_channel, is_admin)
-                
-                # 标记登录完成
-                login_completed = True
-                
-                # 发送登录成功消息
-                login_msg = {
-                    "type": "system",
-                    "channel": current_channel,
-                    "message": f"成功登录，用户名: {current_username}"
-                }
-                
-                # 如果是管理员，添加管理员命令列表
-                if is_admin:
-                    login_msg["admin_commands"] = [
-                        "::kicks [频道id] [用户名] [理由] - 踢出指定频道中的指定用户",
-                        "::kick [频道id] [理由] - 清退指定频道中的所有用户",
-                        "::closes [频道id] [用户名] [理由] - 断开指定用户的连接",
-                        "::close [频道id] [理由] - 关闭频道并断开所有用户连接",
-                        "::lists - 查看全服在线用户名",
-                        f'::say [频道id] [用户名] [消息，用"包裹"] - 向指定用户发送私信'
-                    ]
-                
-                await websocket.send(json.dumps(login_msg))
-                
-                # 广播用户加入消息
-                await broadcast(current_channel, {
-                    "type": "system",
-                    "message": f"{current_username} 加入了频道"
-                })
+            # 解码并校验请求，格式错误时回复错误消息而不断开连接
+            try:
+                action, data = decode_request(message)
+            except ProtocolError as e:
+                actions_handled.inc("invalid")
+                send_reply(websocket, "error", session.channel or "unknown", f"无效的请求: {echo_text(e)}")
+                continue
             
-            # 处理频道选择请求
-            elif data.get('action') == 'choose':
-                if not current_username:
-                    # 获取用户名（可能是自动生成的）
-                    current_username = data.get('username')
-                    if not current_username:
-                        await websocket.send(json.dumps({
-                            "type": "error",
-                            "channel": data.get('new_channel', "unknown"),
-                            "message": "请先登录设置用户名"
-                        }))
-                        continue
-                    
-                new_channel = data.get('new_channel')
-                
-                if not new_channel:
-                    await websocket.send(json.dumps({
-                        "type": "error",
-                        "channel": current_channel or "unknown",
-                        "message": "频道ID不能为空"
-                    }))
-                    continue
-                
-                # 验证新频道是否允许
-                if new_channel not in ALLOWED_CHANNELS:
-                    await websocket.send(json.dumps({
-                        "type": "error",
-                        "channel": new_channel,
-                        "message": f"频道 '{new_channel}' 不被允许"
-                    }))
-                    continue
-                
-                # 验证用户名在新频道是否已存在
-                if new_channel != current_channel and current_username in channels[new_channel]:
-                    await websocket.send(json.dumps({
-                        "type": "error",
-                        "channel": new_channel,
-                        "message": f"用户名 '{current_username}' 在频道 '{new_channel}' 中已存在，请更换用户名"
-                    }))
-                    continue
-                
-                # 从旧频道移除用户
-                if current_channel and current_username in channels[current_channel]:
-                    del channels[current_channel][current_username]
-                    await broadcast(current_channel, {
-                        "type": "system",
-                        "message": f"{current_username} 离开了频道"
-                    })
-                
-                # 更新当前频道
-                current_channel = new_channel
-                channels[current_channel][current_username] = websocket
-                
-                # 更新连接映射
-                connection_map[websocket] = (current_username, current_channel, is_admin)
-                
-                # 广播用户加入新频道消息
-                await broadcast(current_channel, {
-                    "type": "system",
-                    "message": f"{current_username} 加入了频道"
-                })
-                
-                # 通知用户切换成功
-                await websocket.send(json.dumps({
-                    "type": "system",
-                    "channel": current_channel,
-                    "message": f"已切换到频道 '{current_channel}'"
-                }))
-            
-            # 处理查看用户列表命令
-            elif data.get('action') == 'list_command':
-                channel_id = data.get('channel_id')
-                
-                if channel_id not in ALLOWED_CHANNELS:
-                    await websocket.send(json.dumps({
-                        "type": "error",
-                        "channel": current_channel or "unknown",
-                        "message": f"频道 '{channel_id}' 不被允许或不存在"
-                    }))
-                    continue
-                
-                # 获取频道用户列表
-                if channel_id in channels and channels[channel_id]:
-                    users = list(channels[channel_id].keys())
-                    user_list = "    ".join(users)  # 4个空格分隔
-                    await websocket.send(json.dumps({
-                        "type": "user_list",
-                        "channel": channel_id,
-                        "message": f"频道 {channel_id} 在线用户 ({len(users)}):",
-                        "users": user_list
-                    }))
-                else:
-                    await websocket.send(json.dumps({
-                        "type": "system",
-                        "channel": current_channel or "unknown",
-                        "message": f"频道 {channel_id} 中没有在线用户"
-                    }))
-            
-            # 处理管理员命令
-            elif data.get('action') == 'admin_command':
-                if not is_admin:
-                    await websocket.send(json.dumps({
-                        "type": "error",
-                        "channel": current_channel or "unknown",
-                        "message": "你没有权限执行此命令"
-                    }))
-                    continue
-                
-                await handle_admin_command(websocket, data.get('command', ''), current_username)
-            
-            # 处理普通消息
-            elif data.get('action') == 'message':
-                if not current_username or not current_channel or not login_completed:
-                    # 确保登录完成后才能发送消息
-                    continue
-                    
-                message_text = data.get('message', '').strip()
-                if message_text:
-                    await broadcast(current_channel, {
-                        "type": "message",
-                        "username": current_username,
-                        "message": message_text
-                    })
-            
-            # 处理离开请求
-            elif data.get('action') == 'leave':
-                if current_username and current_channel and current_username in channels[current_channel]:
-                    del channels[current_channel][current_username]
-                    await broadcast(current_channel, {
-                        "type": "system",
-                        "message": f"{current_username} 离开了频道"
-                    })
+            actions_handled.inc(action)
+            finished = await ACTION_HANDLERS[action](session, data)
+            settle_pending_login(session)
+            if SLOW_HANDLER_THRESHOLD is not None:
+                trace_slow_handler(describe_action(action, data), session.channel, handler_started)
+            if finished:
                 break
                 
         # 断开连接时清理
-        if current_username and current_channel and current_username in channels[current_channel]:
-            del channels[current_channel][current_username]
-            await broadcast(current_channel, {
-                "type": "system",
-                "message": f"{current_username} 离开了频道"
-            })
-            
-        # 从连接映射移除
-        if websocket in connection_map:
-            del connection_map[websocket]
+        if in_channel(session):
+            leave_channel(session.channel, session.username)
+            announce_presence(session.channel, session.username, "leave")
                 
     except websockets.exceptions.ConnectionClosed:
         # 客户端意外断开连接
-        if current_username and current_channel and current_username in channels[current_channel]:
-            del channels[current_channel][current_username]
-            await broadcast(current_channel, {
-                "type": "system",
-                "message": f"{current_username} 已断开连接"
-            })
-        
-        # 从连接映射移除
-        if websocket in connection_map:
-            del connection_map[websocket]
+        if in_channel(session):
+            # 保留会话期间继续占用用户名
+            leave_channel(session.channel, session.username, release=not session.resume_token)
+            if session.resume_token:
+                # 保留会话等待客户端恢复，宽限期结束后再广播断开消息
+                suspend_session(session.resume_token, session.username, session.channel, session.is_admin)
+            else:
+                announce_presence(session.channel, session.username, "leave")
     except Exception as e:
         print(f"处理客户端错误: {e}")
+    finally:
+        # 处理出错时会话可能仍在频道中，一并移除
+        if in_channel(session):
+            leave_channel(session.channel, session.username)
+            announce_presence(session.channel, session.username, "leave")
+        
+        # 停止写任务并释放会话
+        del sessions[websocket]
+        session.outbox.task.cancel()
+        connections_closed.inc()
+        connection_wheel.cancel(session)
+        settle_pending_login(session)
+        
+        connections_per_ip[client_ip] -= 1
+        if connections_per_ip[client_ip] == 0:
+            del connections_per_ip[client_ip]
+
+async def connect_backplane(unix_path=None):
+    """连接集群背板：配置了 BACKPLANE_ADDRESS 时连接独立中转端，否则连接本机的进程间总线"""
+    global backplane
+    backplane = BrokerBackplane(handle_backplane_message)
+    if BACKPLANE_ADDRESS:
+        host, port = BACKPLANE_ADDRESS.rsplit(":", 1)
+        await backplane.connect_tcp(host, int(port))
+    else:
+        await backplane.connect_unix(unix_path)
+
+async def start_metrics(port):
+    """启动本地 HTTP 指标接口，返回其服务器对象"""
+    metrics_server = await serve_metrics(METRICS_HOST, port)
+    print(f"运行指标接口已启动: http://{METRICS_HOST}:{port}/metrics")
+    return metrics_server
 
 async def main():
-    async with websockets.serve(handle_client, "0.0.0.0", 8765):
-        print(f"聊天服务器已启动，监听端口 8765")
+    if BACKPLANE_ADDRESS:
+        await connect_backplane()
+        print(f"已加入集群，消息总线中转端: {BACKPLANE_ADDRESS}")
+    
+    metrics_server = await start_metrics(METRICS_PORT) if METRICS_PORT else None
+    install_profile_signal(asyncio.get_running_loop())
+    
+    try:
+        async with websockets.serve(handle_client, SERVER_HOST, SERVER_PORT, **serve_options()):
+            print(f"聊天服务器已启动，监听端口 {SERVER_PORT}")
+            print(f"允许的频道: {', '.join(ALLOWED_CHANNELS)}")
+            if BACKPLANE_ADDRESS:
+                # 与中转端断开后本节点状态无法再与集群同步，直接退出
+                await backplane.task
+            else:
+                await asyncio.Future()  # 运行 forever
+    finally:
+        if metrics_server is not None:
+            metrics_server.close()
+
+async def run_worker(worker_id):
+    """工作进程：连接消息总线，并与其他工作进程共享监听端口"""
+    await connect_backplane(BUS_SOCKET_PATH)
+    
+    metrics_server = await start_metrics(METRICS_PORT + worker_id) if METRICS_PORT else None
+    install_profile_signal(asyncio.get_running_loop())
+    
+    try:
+        async with websockets.serve(handle_client, SERVER_HOST, SERVER_PORT, reuse_port=True, **serve_options()):
+            print(f"工作进程 {worker_id} 已启动 (pid {os.getpid()})")
+            # 与消息总线断开后本进程状态无法再与其他进程同步，直接退出
+            await backplane.task
+    finally:
+        if metrics_server is not None:
+            metrics_server.close()
+
+def worker_process(worker_id):
+    """工作进程入口"""
+    try:
+        asyncio.run(run_worker(worker_id))
+    except KeyboardInterrupt:
+        pass
+
+async def run_cluster():
+    """主进程：启动消息总线中转端（未配置集群中转端时），并启动和看护各工作进程"""
+    bus_server = None
+    if not BACKPLANE_ADDRESS:
+        if os.path.exists(BUS_SOCKET_PATH):
+            os.unlink(BUS_SOCKET_PATH)
+        bus_server = await BusBroker().serve_unix(BUS_SOCKET_PATH)
+    
+    context = multiprocessing.get_context("spawn")
+    workers = {}
+    
+    try:
+        print(f"聊天服务器以 {WORKER_COUNT} 个工作进程启动，监听端口 {SERVER_PORT}")
         print(f"允许的频道: {', '.join(ALLOWED_CHANNELS)}")
-        await asyncio.Future()  # 运行 forever
+        while True:
+            # 启动缺失的工作进程，异常退出的工作进程会被重新拉起
+            for worker_id in range(WORKER_COUNT):
+                process = workers.get(worker_id)
+                if process is None or not process.is_alive():
+                    if process is not None:
+                        print(f"工作进程 {worker_id} 已退出 (退出码 {process.exitcode})，正在重启")
+                    process = context.Process(target=worker_process, args=(worker_id,), daemon=True)
+                    process.start()
+                    workers[worker_id] = process
+            await asyncio.sleep(1)
+    finally:
+        for process in workers.values():
+            process.terminate()
+        if bus_server is not None:
+            bus_server.close()
+            os.unlink(BUS_SOCKET_PATH)
 
 if __name__ == "__main__":
     try:
-        asyncio.run(main())
+        asyncio.run(run_cluster() if WORKER_COUNT > 1 else main())
     except KeyboardInterrupt:
         print("\n服务器已关闭")
     
\ No newline at end of file
@@ -0,0 +1,52 @@
+import asyncio
+import math
+
+class TimerWheel:
+    """由单个任务驱动的定时轮：按到期时间把键放入对应的槽，每个刻度取出一个槽中的全部键
+
+    登记和取消都是 O(1)，不为每个键单独创建定时器。超过一圈的延迟按一圈处理，
+    到期时由回调检查实际状态并决定是否重新登记，因此提前到期不影响正确性。
+    """
+
+    def __init__(self, tick, slot_count, on_expire):
+        self.tick = tick
+        self.slots = [set() for _ in range(slot_count)]
+        self.position = 0
+        self.slot_of = {}  # {键: 所在槽的下标}
+        self.on_expire = on_expire  # 回调：参数为同一刻度到期的键的集合
+        self.task = None
+
+    def schedule(self, key, delay):
+        """登记键在 delay 秒后到期，已登记的键改为新的到期时间"""
+        if self.task is None:
+            self.task = asyncio.create_task(self.run())
+        self.cancel(key)
+        ticks = min(len(self.slots) - 1, max(1, math.ceil(delay / self.tick)))
+        index = (self.position + ticks) % len(self.slots)
+        self.slots[index].add(key)
+        self.slot_of[key] = index
+
+    def cancel(self, key):
+        """取消键的登记"""
+        index = self.slot_of.pop(key, None)
+        if index is not None:
+            self.slots[index].discard(key)
+
+    async def run(self):
+        """每个刻度推进一个槽，事件循环繁忙而延迟时连续推进，补上错过的刻度"""
+        loop = asyncio.get_running_loop()
+        next_tick = loop.time()
+        while True:
+            next_tick += self.tick
+            await asyncio.sleep(max(0, next_tick - loop.time()))
+            self.position = (self.position + 1) % len(self.slots)
+            due = self.slots[self.position]
+            if not due:
+                continue
+            self.slots[self.position] = set()
+            for key in due:
+                del self.slot_of[key]
+            try:
+                self.on_expire(due)
+            except Exception as e:
+                print(f"定时轮回调错误: {e}")